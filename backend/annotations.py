@@ -1,85 +1,97 @@
-from typing import Literal, cast
+import os
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Iterator, Literal, cast
 
+import pymupdf
+from highlights import highlight_id
+from metrics import stage
+from parallel import page_ranges, process_pool
 from pymupdf import Annot, Document, Page
+from uploads import PdfSource, open_pdf, remove_file
 
-def convert_annotations_to_highlights(doc: Document) -> list[dict]:
+# Final redaction of documents with at least SHARD_MIN_PAGES pages is split across SHARD_WORKERS processes.
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_MIN_PAGES = int(os.getenv("SHARD_MIN_PAGES", "200"))
+
+@stage("annotation_conversion")
+def page_annotations_to_highlights(page: Page) -> list[dict]:
     """
-    Converts redaction annotations to highlights for the frontend.
+    Converts the redaction annotations of a page to highlights for the frontend and removes them from the page.
     """
     highlights = []
-    if doc.has_annots():
-        for page in doc:
-            for annot in page.annots():
-                if annot.type[0] == 12:
-                    rect = {
-                        "x1": annot.rect[0],
-                        "y1": annot.rect[1],
-                        "x2": annot.rect[2],
-                        "y2": annot.rect[3],
-                    }
-                    rect = {
-                        **rect,
-                        "height": page.rect.height,
-                        "width": page.rect.width,
-                        "pageNumber": page.number + 1,
-                    }
-                    highlight = {
-                        "position": {
-                            "pageNumber": page.number + 1,
-                            "boundingRect": rect,
-                            "rects": [rect],
-                        },
-                        "content": {"text": annot.info.get("subject", "")},
-                        "comment": {"text": "", "emoji": ""},
-                        "id": hash(annot),
-                    }
-                    if comment := annot.info.get("content"):
-                        reference, title, rest = comment.split("\n\n", 2)
-                        full_text, url = rest.rsplit("\n\n", 1)
-                        highlight["ifgRule"] = {
-                            "reference": reference,
-                            "title": title,
-                            "full_text": full_text,
-                            "url": url,
-                        }
-                    highlights.append(highlight)
-                    page.delete_annot(annot)
+    # Collect the annotations first, as deleting them while iterating over them skips some
+    annots = list(page.annots(types=[pymupdf.PDF_ANNOT_REDACT]))
+    for annot in annots:
+        rect = {
+            "x1": annot.rect[0],
+            "y1": annot.rect[1],
+            "x2": annot.rect[2],
+            "y2": annot.rect[3],
+        }
+        rect = {
+            **rect,
+            "height": page.rect.height,
+            "width": page.rect.width,
+            "pageNumber": page.number + 1,
+        }
+        text = annot.info.get("subject", "")
+        highlight = {
+            "position": {
+                "pageNumber": page.number + 1,
+                "boundingRect": rect,
+                "rects": [rect],
+            },
+            "content": {"text": text},
+            "comment": {"text": "", "emoji": ""},
+            "id": highlight_id(page.number + 1, [annot.rect]),
+        }
+        if comment := annot.info.get("content"):
+            reference, title, rest = comment.split("\n\n", 2)
+            full_text, url = rest.rsplit("\n\n", 1)
+            highlight["ifgRule"] = {
+                "reference": reference,
+                "title": title,
+                "full_text": full_text,
+                "url": url,
+            }
+        highlights.append(highlight)
+    for annot in annots:
+        page.delete_annot(annot)
     return highlights
 
+
+def iter_annotations_to_highlights(doc: Document) -> Iterator[list[dict]]:
+    """Like `convert_annotations_to_highlights`, but yields the highlights page by page."""
+    if not doc.has_annots():
+        return
+    for page in doc:
+        yield page_annotations_to_highlights(page)
+
+
+def convert_annotations_to_highlights(doc: Document) -> list[dict]:
+    """
+    Converts redaction annotations to highlights for the frontend.
+    """
+    return [h for highlights in iter_annotations_to_highlights(doc) for h in highlights]
+
+@stage("redaction")
 def apply_annotations(doc: Document, highlights: list[dict], mode: Literal["draft", "final"]):
     """
     Applies redaction annotations to a document, either in draft (yellow transparent overlay) or final mode (black (or pink) redactions).
     """
-    # Process each highlight
+    # Group the highlights by page, so that every page is rewritten only once in final mode
+    highlights_by_page: dict[int, list[dict]] = defaultdict(list)
     for highlight in highlights:
-        page = doc[highlight["position"]["pageNumber"] - 1]  # 0-based index
+        highlights_by_page[highlight["position"]["pageNumber"] - 1].append(highlight)
+
+    pink = (1, 0.41, 0.71)
+    for page_number, page_highlights in highlights_by_page.items():
+        page = doc[page_number]  # 0-based index
         page = cast(Page, page)
-        for i, rect in enumerate(highlight["position"]["rects"]):
-            # We could also use the individual rects that make up for example a paragraph of multiple lines of different shapes, but according to https://pymupdf.readthedocs.io/en/latest/page.html#Page.add_redact_annot, "if a quad is specified, then the enveloping rectangle is taken" anyway.
-
-            # Transform coordinates from frontend to backend
-
-            # react-pdf-highlighter stores the coordinates in a relative format:
-            # the "height" and "width" attributes of the rects give the page dimensions (surprisingly, NOT the rect dimensions),
-            # and the x1, y1, x2, y2 attributes are relative to the page dimensions.
-            # For PyMuPDF, we need to convert these relative coordinates to absolute coordinates.
-
-            page_width_frontend = rect.get("width")
-            page_height_frontend = rect.get("height")
-            page_width_backend = page.rect.width
-            page_height_backend = page.rect.height
-
-            factor_x = page_width_backend / page_width_frontend
-            factor_y = page_height_backend / page_height_frontend
-            coords = [
-                rect["x1"] * factor_x,
-                rect["y1"] * factor_y,
-                rect["x2"] * factor_x,
-                rect["y2"] * factor_y,
-            ]
-
-            # Create (draft) redaction annotation
-            pink = (1, 0.41, 0.71)
+        page_width_backend = page.rect.width
+        page_height_backend = page.rect.height
+        for highlight in page_highlights:
             ifgRule = highlight.get("ifgRule", {})
             short_text = (
                 f"{ifgRule.get('title', '')}, {ifgRule.get('reference', '')}"
@@ -91,14 +103,33 @@ def apply_annotations(doc: Document, highlights: list[dict], mode: Literal["draf
                 if ifgRule
                 else ""
             )
-            annot: Annot = page.add_redact_annot(
-                quad=coords,
-                text=short_text if i == 0 else "",
-                cross_out=False,
-                fill=pink,
-            )
-            annot.set_info(content=long_text, subject=highlight["content"]["text"])
-            # There's some arguments for using other kinds of annotations such as highlight_annot for drafts, because they are displayed better in some viewers such as Apple Preview; but for the sake of standardization, we stick with redact_annot.
+            for i, rect in enumerate(highlight["position"]["rects"]):
+                # We could also use the individual rects that make up for example a paragraph of multiple lines of different shapes, but according to https://pymupdf.readthedocs.io/en/latest/page.html#Page.add_redact_annot, "if a quad is specified, then the enveloping rectangle is taken" anyway.
+
+                # Transform coordinates from frontend to backend
+
+                # react-pdf-highlighter stores the coordinates in a relative format:
+                # the "height" and "width" attributes of the rects give the page dimensions (surprisingly, NOT the rect dimensions),
+                # and the x1, y1, x2, y2 attributes are relative to the page dimensions.
+                # For PyMuPDF, we need to convert these relative coordinates to absolute coordinates.
+                factor_x = page_width_backend / rect.get("width")
+                factor_y = page_height_backend / rect.get("height")
+                coords = [
+                    rect["x1"] * factor_x,
+                    rect["y1"] * factor_y,
+                    rect["x2"] * factor_x,
+                    rect["y2"] * factor_y,
+                ]
+
+                # Create (draft) redaction annotation
+                annot: Annot = page.add_redact_annot(
+                    quad=coords,
+                    text=short_text if i == 0 else "",
+                    cross_out=False,
+                    fill=pink,
+                )
+                annot.set_info(content=long_text, subject=highlight["content"]["text"])
+                # There's some arguments for using other kinds of annotations such as highlight_annot for drafts, because they are displayed better in some viewers such as Apple Preview; but for the sake of standardization, we stick with redact_annot.
         if mode == "final":
             page.apply_redactions()  # This is also done by `scrub` below, but `scrub` gets into errors with redaction annotations, so we already apply them here.
 
@@ -109,3 +140,75 @@ def apply_annotations(doc: Document, highlights: list[dict], mode: Literal["draf
         doc.set_metadata({"producer": "AutoRedact"})
         # we want to see how often our tool will be used :)
     return doc
+
+
+@stage("draft")
+def save_draft(source: PdfSource, highlights: list[dict]) -> bytes | str:
+    """
+    Adds draft redaction annotations to a PDF and appends them as an incremental update to a copy of
+    the original file, instead of rewriting the whole document, so that the export time depends on the
+    number of annotations rather than the size of the document.
+    Returns bytes or a temporary path, like `PdfSource.save`.
+    """
+    path = source.copy_to_temporary()
+    doc = open_pdf(path)
+    apply_annotations(doc, highlights, "draft")
+    if not doc.can_save_incrementally():
+        # e.g. for damaged files that PyMuPDF had to repair when opening them
+        pdf = source.save(doc, garbage=1)
+        doc.close()
+        remove_file(path)
+        return pdf
+    doc.saveIncr()
+    doc.close()
+    if not source.in_memory:
+        return path
+    with open(path, "rb") as f:
+        pdf = f.read()
+    remove_file(path)
+    return pdf
+
+
+def use_sharding(doc: Document, mode: Literal["draft", "final"]) -> bool:
+    return mode == "final" and SHARD_WORKERS > 1 and doc.page_count >= SHARD_MIN_PAGES
+
+
+def _redact_shard(pdf: bytes | str, start: int, stop: int, highlights: list[dict]) -> bytes:
+    doc = open_pdf(pdf)
+    doc.select(range(start, stop))
+    apply_annotations(doc, highlights, "final")
+    return doc.tobytes(garbage=1)
+
+
+def apply_annotations_sharded(
+    pdf: bytes | str, highlights: list[dict], workers: int = SHARD_WORKERS
+) -> Document:
+    """
+    Applies final redactions like `apply_annotations`, but splits the document (given by its bytes or path)
+    into page ranges that are redacted and scrubbed in worker processes, and reassembles the result.
+    """
+    original = open_pdf(pdf)
+    ranges = page_ranges(original.page_count, workers)
+    starts = [start for start, _ in ranges]
+    shard_highlights = {start: [] for start in starts}
+    for highlight in highlights:
+        page_number = highlight["position"]["pageNumber"] - 1
+        start = starts[bisect_right(starts, page_number) - 1]
+        shard_highlights[start].append(
+            {
+                **highlight,
+                "position": {**highlight["position"], "pageNumber": page_number - start + 1},
+            }
+        )
+
+    with process_pool(len(ranges)) as executor:
+        futures = [
+            executor.submit(_redact_shard, pdf, start, stop, shard_highlights[start])
+            for start, stop in ranges
+        ]
+        doc = pymupdf.open()
+        for future in futures:
+            doc.insert_pdf(pymupdf.open(stream=future.result(), filetype="pdf"))
+    doc.set_toc(original.get_toc())  # the outline is lost when the shards are joined
+    doc.set_metadata({"producer": "AutoRedact"})
+    return doc
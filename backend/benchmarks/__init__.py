@@ -0,0 +1 @@
+"""Benchmarks, run from the backend directory, e.g. `uv run python -m benchmarks.redaction`."""
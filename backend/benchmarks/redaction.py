@@ -0,0 +1,88 @@
+"""
+Benchmark for final redaction on a dense document: applying all redactions of a page at once
+(`annotations.apply_annotations`) versus applying them after every single highlight.
+With --shards, the sharded multi-process redaction is timed as well, and its output is checked
+to have the same redaction content as the single-process output.
+
+Usage: uv run python -m benchmarks.redaction [--pages 100] [--names-per-page 40] [--shards 4]
+"""
+
+import argparse
+import time
+
+import pymupdf
+from annotations import apply_annotations, apply_annotations_sharded
+from pymupdf import Document
+
+from benchmarks.synthetic import highlight_names, synthetic_pdf
+
+
+def apply_per_highlight(doc: Document, highlights: list[dict]):
+    """The former approach, which rewrites the page after every highlight, for comparison."""
+    for highlight in highlights:
+        page = doc[highlight["position"]["pageNumber"] - 1]
+        for rect in highlight["position"]["rects"]:
+            factor_x = page.rect.width / rect["width"]
+            factor_y = page.rect.height / rect["height"]
+            coords = [rect["x1"] * factor_x, rect["y1"] * factor_y, rect["x2"] * factor_x, rect["y2"] * factor_y]
+            page.add_redact_annot(quad=coords, cross_out=False, fill=(1, 0.41, 0.71))
+        page.apply_redactions()
+    doc.scrub(redact_images=1, reset_responses=False)
+
+
+def same_redaction_content(a: Document, b: Document) -> bool:
+    """Whether two redacted documents have the same pages, text (incl. positions) and images."""
+    if a.page_count != b.page_count:
+        return False
+    for page_a, page_b in zip(a, b):
+        if page_a.get_text("words") != page_b.get_text("words"):
+            return False
+        if len(page_a.get_images()) != len(page_b.get_images()):
+            return False
+        if page_a.rect != page_b.rect:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--names-per-page", type=int, default=40)
+    parser.add_argument("--shards", type=int, default=0, help="number of worker processes")
+    args = parser.parse_args()
+
+    doc, names = synthetic_pdf(args.pages, args.names_per_page)
+    pdf_bytes = doc.tobytes()
+    highlights = highlight_names(doc, names)
+    print(f"{args.pages} pages, {len(highlights)} highlights")
+
+    timings = {}
+    for name, apply in [
+        ("per highlight", lambda doc: apply_per_highlight(doc, highlights)),
+        ("per page", lambda doc: apply_annotations(doc, highlights, "final")),
+    ]:
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        start = time.perf_counter()
+        apply(doc)
+        doc.tobytes(garbage=1)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>15}: {timings[name]:.2f}s")
+    print(f"Speedup: {timings['per highlight'] / timings['per page']:.1f}x")
+
+    if args.shards:
+        reference = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        apply_annotations(reference, highlights, "final")
+        reference = pymupdf.open(stream=reference.tobytes(garbage=1), filetype="pdf")
+        start = time.perf_counter()
+        sharded = apply_annotations_sharded(pdf_bytes, highlights, args.shards)
+        sharded_bytes = sharded.tobytes(garbage=1)
+        duration = time.perf_counter() - start
+        print(f"{'sharded':>15}: {duration:.2f}s with {args.shards} processes")
+        same = same_redaction_content(reference, pymupdf.open(stream=sharded_bytes, filetype="pdf"))
+        print(f"Same redaction content as single process: {same}")
+        if not same:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Synthetic PDFs with a controllable number of person names, for benchmarks.
+"""
+
+import random
+
+import pymupdf
+from pymupdf import Document
+
+FIRST_NAMES = ["Anna", "Max", "Erika", "Jonas", "Fatma", "Lukas", "Sophie", "Mehmet", "Clara", "Paul"]
+LAST_NAMES = ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Yilmaz", "Wagner", "Becker"]
+FILLER = {
+    "de": (
+        "Der Antrag auf Informationszugang wurde geprüft und der Vorgang an das zuständige Referat "
+        "weitergeleitet, welches die Unterlagen zur Stellungnahme vorgelegt hat"
+    ).split(),
+    "en": (
+        "The request for access to information was reviewed and the case was forwarded to the "
+        "responsible unit, which submitted the documents for comment"
+    ).split(),
+}
+
+
+def synthetic_pdf(
+    pages: int, names_per_page: int, seed: int = 0, language: str = "de"
+) -> tuple[Document, list[str]]:
+    """
+    Creates a document with lines of German or English filler text, in which `names_per_page`
+    person names are placed on every page. Returns the document and the names that occur in it.
+    """
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+    names = set()
+    for _ in range(pages):
+        page = doc.new_page()
+        words = [rng.choice(FILLER[language]) for _ in range(max(300, names_per_page * 8))]
+        for position in rng.sample(range(len(words)), names_per_page):
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            words[position] = name
+            names.add(name)
+        page.insert_textbox(page.rect + (50, 50, -50, -50), " ".join(words), fontsize=8)
+    return doc, sorted(names)
+
+
+def highlight_names(doc: Document, names: list[str]) -> list[dict]:
+    """Creates highlights in the frontend format for all occurrences of the names."""
+    highlights = []
+    for page in doc:
+        for name in names:
+            for rect in page.search_for(name):
+                rect_obj = {
+                    "x1": rect.x0,
+                    "y1": rect.y0,
+                    "x2": rect.x1,
+                    "y2": rect.y1,
+                    "width": page.rect.width,
+                    "height": page.rect.height,
+                    "pageNumber": page.number + 1,
+                }
+                highlights.append(
+                    {
+                        "content": {"text": name},
+                        "comment": {"text": "", "emoji": ""},
+                        "position": {
+                            "boundingRect": rect_obj,
+                            "rects": [rect_obj],
+                            "pageNumber": page.number + 1,
+                        },
+                    }
+                )
+    return highlights
@@ -0,0 +1,179 @@
+"""
+Throughput and memory benchmark of the engines on synthetic German and English documents.
+
+Every engine runs in a fresh process (so that its peak RSS is measured separately), loads its models
+and then analyzes documents of the given sizes with `process_pdf_streaming`, followed by a draft and
+a final redaction of the highlights. The llm engine replays a stub response that redacts the names
+of each page, so no LLM is needed. The results are written to a JSON file, which can be compared to
+the results of another commit with --compare.
+
+Usage: uv run python -m benchmarks.throughput [--engines flair,llm]
+           [--pages 1,10,100,500] [--names-per-page 10] [--languages de,en] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from pymupdf import Document
+
+from benchmarks.synthetic import synthetic_pdf
+from engines import ENGINES, get_engine
+from parallel import process_pool
+
+
+def write_llm_stub(doc: Document, names: list[str], path: str, chunk_size: int = 20):
+    """Writes a recording (see `llm_replay`) that redacts the names occurring on each page."""
+    lines = []
+    for page in doc:
+        lines.append(f"PAGE: {page.number + 1}")
+        text = " ".join(page.get_text().split())
+        lines += [f'REDACT: "{name}" | Personenbezogene Daten' for name in names if name in text]
+    response = "\n".join(lines) + "\n"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(0, len(response), chunk_size):
+            f.write(json.dumps({"content": response[i : i + chunk_size], "finish_reason": None}) + "\n")
+        f.write(json.dumps({"content": None, "finish_reason": "stop"}) + "\n")
+
+
+def run_engine(
+    engine: str, sizes: list[int], names_per_page: int, languages: list[str], trace: bool
+) -> list[dict]:
+    """Runs the benchmark of an engine (in a fresh worker process)."""
+    from annotations import apply_annotations, save_draft
+    from extraction import extract
+    from uploads import PdfSource
+
+    start = time.perf_counter()
+    module = get_engine(engine)
+    module.preload(languages)
+    load_seconds = time.perf_counter() - start
+
+    results = []
+    for language in languages:
+        for pages in sizes:
+            doc, names = synthetic_pdf(pages, names_per_page, language=language)
+            source = PdfSource(data=doc.tobytes())
+            doc = source.open()
+            stub = None
+            if engine == "llm":
+                from llm_replay import replay_completion
+
+                stub = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False).name
+                write_llm_stub(doc, names, stub)
+                module.completion = replay_completion(stub)
+            if trace:
+                tracemalloc.start()
+
+            stages = {}
+            start = time.perf_counter()
+            extract(doc)  # cached on the document, so that the engine doesn't extract it again
+            stages["extraction"] = time.perf_counter() - start
+            first_highlight = None
+            highlights = []
+            for event in module.process_pdf_streaming(doc, "")():
+                if not event.startswith('data: {"status":'):
+                    first_highlight = first_highlight or time.perf_counter() - start
+                    highlights.append(json.loads(event.removeprefix("data: ")))
+            stages["analysis"] = time.perf_counter() - start - stages["extraction"]
+            analysis_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            save_draft(source, highlights)
+            stages["draft"] = time.perf_counter() - start
+            start = time.perf_counter()
+            final = source.open()
+            apply_annotations(final, highlights, "final")
+            final.tobytes(garbage=1)
+            stages["final"] = time.perf_counter() - start
+
+            result = {
+                "engine": engine,
+                "language": language,
+                "pages": pages,
+                "names_per_page": names_per_page,
+                "highlights": len(highlights),
+                "pages_per_second": pages / analysis_seconds,
+                "time_to_first_highlight": first_highlight,
+                "stages": {"load": load_seconds, **stages},
+                # ru_maxrss is in KiB on Linux; it is the peak of the whole process so far
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+            if trace:
+                result["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+            if stub:
+                os.remove(stub)
+            results.append(result)
+            print(
+                f"{engine:>8} {language} {pages:>4} pages: {result['pages_per_second']:7.2f} pages/s, "
+                f"first highlight after {first_highlight or 0:.2f}s, "
+                f"draft {stages['draft']:.2f}s, final {stages['final']:.2f}s, "
+                f"{result['peak_rss_mb']:.0f} MB peak RSS"
+            )
+    return results
+
+
+def compare(old_path: str, results: list[dict]):
+    """Prints the change of throughput and peak memory relative to the results of an earlier run."""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = {(r["engine"], r["language"], r["pages"]): r for r in json.load(f)["results"]}
+    for result in results:
+        before = old.get((result["engine"], result["language"], result["pages"]))
+        if before is None:
+            continue
+        speed = result["pages_per_second"] / before["pages_per_second"] - 1
+        memory = result["peak_rss_mb"] / before["peak_rss_mb"] - 1
+        print(
+            f"{result['engine']:>8} {result['language']} {result['pages']:>4} pages: "
+            f"throughput {speed:+.1%}, peak RSS {memory:+.1%}"
+        )
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--pages", default="1,10,100,500", help="document sizes (comma-separated)")
+    parser.add_argument("--names-per-page", type=int, default=10)
+    parser.add_argument("--languages", default="de,en")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace Python allocations (slow)")
+    parser.add_argument("--output", help="JSON file for the results (default: benchmark-<commit>.json)")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    commit = _commit()
+    sizes = [int(pages) for pages in args.pages.split(",")]
+    languages = args.languages.split(",")
+    results = []
+    for engine in args.engines.split(","):
+        # a fresh process per engine, for separate model loading and peak memory
+        with process_pool(1) as executor:
+            try:
+                results += executor.submit(
+                    run_engine, engine, sizes, args.names_per_page, languages, args.tracemalloc
+                ).result()
+            except Exception as e:
+                print(f"Warning: Benchmark of {engine} failed: {e}")
+
+    output = args.output or f"benchmark-{commit}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "created": time.time(), "results": results}, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
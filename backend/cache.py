@@ -0,0 +1,120 @@
+"""
+Content-addressed cache for the results of /api/analyze-pdf.
+
+Results are the SSE events of an analysis, keyed by the SHA-256 of the PDF bytes, the engine,
+its configuration (the model, see `engines.cache_tag`), the prompt and the version of the IFG rules.
+Recently used results are kept in memory; optionally, they are also written to a directory on disk,
+which is trimmed to a maximum size.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Generator, Iterable
+
+# Number of results kept in memory; 0 disables the in-memory tier.
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "128"))
+# Directory of the on-disk tier; disabled if not set.
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR")
+ANALYSIS_CACHE_DIR_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_DIR_MAX_BYTES", str(512 * 2**20)))
+
+with open("../rules/informationsfreiheitsgesetz.json", "rb") as f:
+    rules_version = hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_key(pdf_sha256: str, engine: str, prompt: str, model: str | None = None) -> str:
+    parts = [pdf_sha256, engine, model or "", prompt, rules_version]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self,
+        max_entries: int = ANALYSIS_CACHE_SIZE,
+        directory: str | None = ANALYSIS_CACHE_DIR,
+        max_bytes: int = ANALYSIS_CACHE_DIR_MAX_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, list[str]] = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key: str, events: list[str]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = events
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> list[str] | None:
+        with self._lock:
+            events = self._entries.get(key)
+            if events is not None:
+                self._entries.move_to_end(key)
+        if events is None and self.directory:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    events = json.load(f)
+                os.utime(self._path(key))  # the modification time serves as the last access time
+                self._remember(key, events)
+            except (OSError, ValueError):
+                events = None
+        with self._lock:
+            if events is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return events
+
+    def put(self, key: str, events: list[str]):
+        self._remember(key, events)
+        if self.directory:
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(events, f)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used files until the directory fits into max_bytes."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def record(self, key: str, events: Iterable[str]) -> Generator:
+        """Passes the events through and stores them once the analysis has completed."""
+        recorded = []
+        for event in events:
+            recorded.append(event)
+            yield event
+        self.put(key, recorded)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+analysis_cache = ResultCache()
@@ -0,0 +1,159 @@
+"""
+Redacts a directory (or glob) of PDFs without the web app.
+
+The documents are analyzed and redacted in parallel by worker processes, each of which loads the
+models of the engine once. For every input, a draft or final PDF is written to the output directory
+(in the same subdirectory as the input, relative to the common directory of all inputs), and a line with its highlights and timings is appended to a JSONL summary. Inputs whose output is
+newer than the input are skipped, so that an interrupted run can be resumed.
+
+Usage: uv run python cli.py "dossier/*.pdf" --out redacted --engine flair --mode draft
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+from concurrent.futures import as_completed
+
+from engines import DEFAULT_ENGINE, ENGINES, get_engine
+from parallel import process_pool
+
+_engine = None  # the engine module of a worker process
+
+
+def init_worker(engine: str, languages: list[str], workers: int):
+    """Loads the models of an engine in a worker process."""
+    global _engine
+    from quantization import configure_threads
+
+    _engine = get_engine(engine)
+    configure_threads(workers)  # share the cores with the other workers
+    _engine.preload(languages)
+
+
+def analyze(doc, prompt: str, **options) -> list[dict]:
+    """Returns the highlights found by the engine of the worker process."""
+    return [
+        json.loads(event.removeprefix("data: "))
+        for event in _engine.process_pdf_streaming(doc, prompt, **options)()
+        if not event.startswith('data: {"status":')
+    ]
+
+
+def _redact(input_path: str, output_path: str, prompt: str, mode: str) -> dict:
+    from annotations import apply_annotations, save_draft
+    from uploads import PdfSource
+
+    source = PdfSource(path=input_path)
+    start = time.perf_counter()
+    doc = source.open()
+    highlights = analyze(doc, prompt)
+    analyzed = time.perf_counter()
+    # written next to the output and renamed, so that an interrupted run leaves no truncated output
+    # that would be skipped as up to date when the run is resumed
+    temporary_path = f"{output_path}.tmp"
+    try:
+        if mode == "draft":
+            shutil.move(save_draft(source, highlights), temporary_path)
+        else:
+            apply_annotations(doc, highlights, mode)
+            doc.save(temporary_path, garbage=1)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return {
+        "pages": doc.page_count,
+        "highlights": [
+            {
+                "page": highlight["position"]["pageNumber"],
+                "text": highlight["content"]["text"],
+                "rule": highlight.get("ifgRule", {}).get("title"),
+            }
+            for highlight in highlights
+        ],
+        "analysis_seconds": round(analyzed - start, 3),
+        "redaction_seconds": round(time.perf_counter() - analyzed, 3),
+    }
+
+
+def find_pdfs(paths: list[str]) -> list[str]:
+    """Returns the PDFs among files, directories (searched recursively) and glob patterns."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, "**", "*.pdf")
+        files += [f for f in glob.glob(path, recursive=True) if f.lower().endswith(".pdf")]
+    return sorted(set(files))
+
+
+def _output_path(input_path: str, root: str, out_dir: str, mode: str) -> str:
+    """The output of an input, at the same path relative to `out_dir` as the input is to `root`."""
+    stem, ext = os.path.splitext(os.path.relpath(os.path.abspath(input_path), root))
+    return os.path.join(out_dir, f"{stem}{'_redaction_draft' if mode == 'draft' else '_redacted'}{ext}")
+
+
+def _up_to_date(input_path: str, output_path: str) -> bool:
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories or glob patterns")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--engine", choices=list(ENGINES), default=DEFAULT_ENGINE)
+    parser.add_argument("--mode", choices=["draft", "final"], default="draft")
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--languages", default="de", help="models to load in advance (comma-separated)")
+    parser.add_argument("--summary", help="JSONL summary (default: <out>/summary.jsonl)")
+    parser.add_argument("--force", action="store_true", help="also redact inputs with up-to-date outputs")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    summary_path = args.summary or os.path.join(args.out, "summary.jsonl")
+    inputs = find_pdfs(args.inputs)
+    # inputs with the same name in different directories get outputs in different directories
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in inputs]) if inputs else ""
+    tasks = []
+    for input_path in inputs:
+        output_path = _output_path(input_path, root, args.out, args.mode)
+        if args.force or not _up_to_date(input_path, output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tasks.append((input_path, output_path))
+    print(f"Redacting {len(tasks)} documents ({len(inputs) - len(tasks)} up to date)")
+    if not tasks:
+        return
+
+    languages = [lang.strip() for lang in args.languages.split(",") if lang.strip()]
+    workers = max(1, min(args.workers, len(tasks)))
+    with (
+        process_pool(
+            workers,
+            initializer=init_worker,
+            initargs=(args.engine, languages, workers),
+        ) as executor,
+        open(summary_path, "a", encoding="utf-8") as summary,
+    ):
+        futures = {
+            executor.submit(_redact, input_path, output_path, args.prompt, args.mode): (input_path, output_path)
+            for input_path, output_path in tasks
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            input_path, output_path = futures[future]
+            record = {"input": input_path, "output": output_path, "engine": args.engine, "mode": args.mode}
+            try:
+                record.update(future.result())
+                print(f"[{done}/{len(tasks)}] {input_path}: {len(record['highlights'])} highlights")
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+                print(f"[{done}/{len(tasks)}] {input_path}: failed ({record['error']})")
+            summary.write(json.dumps(record, ensure_ascii=False) + "\n")
+            summary.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Registry of the analysis engines.
+
+Engines are registered by name with the module that implements them (`preload(langs)`,
+`process_pdf_streaming(doc, prompt)` and `cache_tag()`, a fingerprint of the settings that change
+the results). A module is only imported when its engine is first used, so that unused engines
+(and their dependencies such as torch or litellm) cost no import time and no memory. ENGINE selects the default engine of the app.
+"""
+
+import importlib
+import os
+import threading
+from types import ModuleType
+
+ENGINES: dict[str, str] = {
+    "flair": "processing_ner_flair",
+    "spacy": "processing_ner_spacy",
+    "stanza": "processing_ner_stanza",
+    "patterns": "processing_patterns",
+    "llm": "processing_ai",
+}
+DEFAULT_ENGINE = os.getenv("ENGINE", "flair")
+
+_modules: dict[str, ModuleType] = {}
+_lock = threading.Lock()
+
+
+def register(name: str, module: str):
+    """Registers an engine by the name of the module that implements it."""
+    ENGINES[name] = module
+
+
+def get_engine(name: str) -> ModuleType:
+    """Returns the module of an engine, importing it on first use. Raises KeyError for unknown engines."""
+    module = _modules.get(name)
+    if module is None:
+        with _lock:
+            if name not in _modules:
+                _modules[name] = importlib.import_module(ENGINES[name])
+            module = _modules[name]
+    return module
+
+
+def cache_tag(name: str) -> str:
+    """Fingerprint of the configuration of an engine, which is part of the cache key of its results."""
+    return get_engine(name).cache_tag()
@@ -1,76 +1,197 @@
-import difflib
+"""
+Evaluates the engines on a corpus of PDFs with redaction annotations (e.g. drafts exported by the app).
+
+The gold redactions are the rectangles of the redaction annotations, which are removed before the
+document is analyzed. Predicted highlights are split into their rectangles as well, since some engines
+return one highlight per occurrence and others one highlight for all occurrences of a text on a page.
+Gold and predicted rectangles are matched geometrically: a gold rectangle counts as found (recall) and
+a predicted one as correct (precision) if at least --threshold of its area is covered by rectangles of
+the other kind on the same page. The files are evaluated in parallel by worker
+processes that load the models of the engine once.
+
+Usage: uv run python evaluation.py "corpus/*.pdf" --engines flair,spacy
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import as_completed
 
 import pymupdf
-from processing_ai import ifg_text, process_pdf
+from annotations import convert_annotations_to_highlights
+from cli import analyze, find_pdfs, init_worker
+from engines import DEFAULT_ENGINE, ENGINES
+from parallel import process_pool
 from pymupdf import Document
 
-
-def copy_doc(doc: Document) -> Document:
-    # make a deep copy of the document
-    # see https://github.com/pymupdf/PyMuPDF/discussions/2569
-    return pymupdf.open("pdf", doc.tobytes())
-
-
-def read_redactions_from_pdf(doc: Document) -> list[str]:
-    doc = copy_doc(
-        doc
-    )  # make a deep copy because later we will modify the redaction comments
-    unredacted_text = "\n\n".join([page.get_text() for page in doc])
-    for page in doc:
-        for annot in page.annots():
-            if annot.type[0] == 12:
-                # replace annot with annot without text
-                # this modifies the document in place
-                coords = annot.rect
-                page.delete_annot(annot)
-                page.add_redact_annot(quad=coords, text=None)
-        page.apply_redactions()
-    redacted_text = "\n\n".join([page.get_text() for page in doc])
-
-    def is_junk(element: str) -> bool:
-        return element in []
-
-    matcher = difflib.SequenceMatcher(is_junk, unredacted_text, redacted_text)
-
-    redactions = []
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        assert tag in ["equal", "delete", "replace"]
-        if tag == "delete" or tag == "replace":
-            if tag == "replace":
-                assert redacted_text[j1:j2].strip() == ""
-            redactions.append(unredacted_text[i1:i2].strip().replace("\n", " "))
-    return redactions
-
-
-def simple_evaluation(true_items: list[str], pred_items: list[str]):
-    true_set = set(item.strip() for item in true_items)
-    pred_set = set(item.strip() for item in pred_items)
-
-    tp = len(true_set.intersection(pred_set))
-    fp = len(pred_set - true_set)
-    fn = len(true_set - pred_set)
-
-    precision = tp / (tp + fp) if (tp + fp) else 0
-    recall = tp / (tp + fn) if (tp + fn) else 0
+MATCH_THRESHOLD = 0.5
+
+
+def highlight_rects(doc: Document, highlight: dict) -> list[pymupdf.Rect]:
+    """Converts the (relative) rects of a frontend highlight to PDF coordinates."""
+    page = doc[highlight["position"]["pageNumber"] - 1]
+    return [
+        pymupdf.Rect(
+            rect["x1"] * page.rect.width / rect["width"],
+            rect["y1"] * page.rect.height / rect["height"],
+            rect["x2"] * page.rect.width / rect["width"],
+            rect["y2"] * page.rect.height / rect["height"],
+        )
+        for rect in highlight["position"]["rects"]
+    ]
+
+
+def _overlap(a: pymupdf.Rect, b: pymupdf.Rect) -> float:
+    width = min(a.x1, b.x1) - max(a.x0, b.x0)
+    height = min(a.y1, b.y1) - max(a.y0, b.y0)
+    return max(0, width) * max(0, height)
+
+
+def coverage(rects: list[pymupdf.Rect], others: list[pymupdf.Rect]) -> float:
+    """Share of the area of `rects` that is covered by `others` (assuming `others` don't overlap)."""
+    area = sum(abs(rect) for rect in rects)
+    if not area:
+        return 0
+    return min(1, sum(_overlap(rect, other) for rect in rects for other in others) / area)
+
+
+def units(doc: Document, highlights: list[dict]) -> list[tuple[int, pymupdf.Rect, str]]:
+    """Splits highlights into the units that are scored: (page number, rect, text) for each of their rects."""
+    return [
+        (h["position"]["pageNumber"], rect, h["content"]["text"])
+        for h in highlights
+        for rect in highlight_rects(doc, h)
+    ]
+
+
+def match(
+    gold: list[tuple[int, pymupdf.Rect, str]],
+    predicted: list[tuple[int, pymupdf.Rect, str]],
+    threshold: float = MATCH_THRESHOLD,
+) -> tuple[list[bool], list[bool]]:
+    """Returns for every gold unit whether it has been found, and for every predicted unit whether it is correct."""
+
+    def by_page(units: list[tuple[int, pymupdf.Rect, str]]) -> dict[int, list[pymupdf.Rect]]:
+        pages = defaultdict(list)
+        for page_number, rect, _ in units:
+            pages[page_number].append(rect)
+        return pages
+
+    # units are only compared with those on the same page
+    gold_pages, predicted_pages = by_page(gold), by_page(predicted)
+    found = [
+        coverage([rect], predicted_pages.get(page_number, [])) >= threshold
+        for page_number, rect, _ in gold
+    ]
+    correct = [
+        coverage([rect], gold_pages.get(page_number, [])) >= threshold
+        for page_number, rect, _ in predicted
+    ]
+    return found, correct
+
+
+def evaluate_file(path: str, prompt: str, threshold: float, options: dict) -> dict:
+    doc = pymupdf.open(path)
+    gold = units(doc, convert_annotations_to_highlights(doc))  # also removes the annotations
+    start = time.perf_counter()
+    highlights = analyze(doc, prompt, **options)
+    seconds = time.perf_counter() - start
+    predicted = units(doc, highlights)
+    found, correct = match(gold, predicted, threshold)
+    return {
+        "pages": doc.page_count,
+        "seconds": round(seconds, 3),
+        "gold": len(gold),
+        "found": sum(found),
+        "predicted": len(predicted),
+        "correct": sum(correct),
+        "missed": [text for (_, _, text), ok in zip(gold, found) if not ok],
+        "spurious": [text for (_, _, text), ok in zip(predicted, correct) if not ok],
+    }
+
+
+def scores(results: list[dict]) -> dict:
+    """Micro-averaged precision, recall and F1 over the files, and the throughput."""
+    gold = sum(r["gold"] for r in results)
+    predicted = sum(r["predicted"] for r in results)
+    precision = sum(r["correct"] for r in results) / predicted if predicted else 0
+    recall = sum(r["found"] for r in results) / gold if gold else 0
     f1 = 2 * precision * recall / (precision + recall) if (precision + recall) else 0
-
-    return precision, recall, f1
-
-
-def evaluate_pdf_redactions(doc: Document, model: str):
-    redactions_true = read_redactions_from_pdf(doc)
-    print("True redactions:", redactions_true)
-
-    redactions_pred = process_pdf(doc, ifg_text, model=model)
-    redactions_pred = [highlight["content"]["text"] for highlight in redactions_pred]
-    print("Predicted redactions:", redactions_pred)
-
-    precision, recall, f1 = simple_evaluation(redactions_true, redactions_pred)
-    print("Precision:", precision)
-    print("Recall:", recall)
-    print("F1 score:", f1)
-
-
-doc = pymupdf.open("pdfs/draft_vermerk.pdf")
-evaluate_pdf_redactions(doc, model="azure/gpt-4o-mini")
-evaluate_pdf_redactions(doc, model="azure/gpt-4o")
+    seconds = sum(r["seconds"] for r in results)
+    pages = sum(r["pages"] for r in results)
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "seconds": seconds,
+        "pages_per_second": pages / seconds if seconds else 0,
+    }
+
+
+def evaluate_engine(
+    engine: str,
+    files: list[str],
+    prompt: str = "",
+    workers: int = 1,
+    languages: list[str] | None = None,
+    threshold: float = MATCH_THRESHOLD,
+    options: dict | None = None,
+) -> dict[str, dict]:
+    """Evaluates an engine on the files in parallel and returns the results per file."""
+    languages = languages if languages is not None else ["de"]
+    options = options or {}
+    results = {}
+    workers = max(1, min(workers, len(files)))
+    with process_pool(
+        workers,
+        initializer=init_worker,
+        initargs=(engine, languages, workers),
+    ) as executor:
+        futures = {
+            executor.submit(evaluate_file, path, prompt, threshold, options): path for path in files
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"Warning: Could not evaluate {futures[future]} with {engine}: {e}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="annotated PDF files, directories or glob patterns")
+    parser.add_argument("--engines", default=DEFAULT_ENGINE, help=f"comma-separated, from {', '.join(ENGINES)}")
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--model", help="LLM for the llm engine")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--languages", default="de", help="models to load in advance (comma-separated)")
+    parser.add_argument("--threshold", type=float, default=MATCH_THRESHOLD)
+    parser.add_argument("--report", help="JSONL file for the results per file and engine")
+    args = parser.parse_args()
+
+    files = find_pdfs(args.inputs)
+    languages = [lang.strip() for lang in args.languages.split(",") if lang.strip()]
+    print(f"Evaluating on {len(files)} documents")
+    report = open(args.report, "w", encoding="utf-8") if args.report else None
+    for engine in args.engines.split(","):
+        options = {"model": args.model} if args.model and engine == "llm" else {}
+        results = evaluate_engine(
+            engine, files, args.prompt, args.workers, languages, args.threshold, options
+        )
+        s = scores(list(results.values()))
+        print(
+            f"{engine:>8}: P={s['precision']:.3f} R={s['recall']:.3f} F1={s['f1']:.3f} "
+            f"in {s['seconds']:.1f}s ({s['pages_per_second']:.2f} pages/s)"
+        )
+        if report:
+            for path, result in sorted(results.items()):
+                report.write(json.dumps({"engine": engine, "file": path, **result}, ensure_ascii=False) + "\n")
+    if report:
+        report.close()
+
+
+if __name__ == "__main__":
+    main()
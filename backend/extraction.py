@@ -0,0 +1,159 @@
+"""
+Shared text extraction for an uploaded document.
+
+The text of every page is extracted once (from PyMuPDF's "rawdict" output) and then shared
+by language detection, the NER engines, the LLM prompt builder and the highlight lookup.
+The page text is identical to `page.get_text()`, so character offsets into it can be used
+interchangeably with the offsets the engines used before. Each page also keeps the box of
+every character, so that character offsets found by an engine map directly to the rects
+of a highlight, without searching the page again.
+"""
+
+import os
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+import pymupdf
+from metrics import stage
+from parallel import page_ranges, process_pool
+from pymupdf import Document, Page, Rect
+
+# Documents with at least this many pages are extracted in a process pool, if enabled.
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "0"))
+EXTRACTION_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACTION_PARALLEL_MIN_PAGES", "200"))
+
+# A word is (x0, y0, x1, y1, text, start, end), with start and end being character offsets into the page text.
+Word = tuple[float, float, float, float, str, int, int]
+Box = tuple[float, float, float, float]
+
+
+@dataclass
+class PageText:
+    number: int  # 0-based, like `page.number`
+    text: str
+    words: list[Word] = field(default_factory=list)
+    boxes: list[Box | None] = field(default_factory=list)  # per character; None for line breaks
+    line_starts: list[int] = field(default_factory=list)  # character offset of each line
+
+    def rects(self, start: int, end: int) -> list[Rect]:
+        """
+        Returns one rect per line for the characters between the offsets start and end,
+        like `page.search_for` does for a match. Whitespace at the ends of a line is ignored.
+        """
+        rects = []
+        line = max(0, bisect_right(self.line_starts, start) - 1)
+        while line < len(self.line_starts) and self.line_starts[line] < end:
+            line_end = (
+                self.line_starts[line + 1] if line + 1 < len(self.line_starts) else len(self.boxes)
+            )
+            x0 = y0 = float("inf")
+            x1 = y1 = float("-inf")
+            for i in range(max(start, self.line_starts[line]), min(end, line_end)):
+                box = self.boxes[i]
+                if box is None or self.text[i].isspace():
+                    continue
+                x0, y0 = min(x0, box[0]), min(y0, box[1])
+                x1, y1 = max(x1, box[2]), max(y1, box[3])
+            if x0 <= x1:
+                rects.append(Rect(x0, y0, x1, y1))
+            line += 1
+        return rects
+
+
+def extract_page(page: Page) -> PageText:
+    """Extracts the text of a page together with its word boxes and their character offsets."""
+    parts = []
+    words = []
+    boxes = []
+    line_starts = []
+    offset = 0
+    for block in page.get_text("rawdict")["blocks"]:
+        if block["type"] != 0:  # image block
+            continue
+        for line in block["lines"]:
+            line_starts.append(offset)
+            word = None  # [x0, y0, x1, y1, chars, start]
+            for span in line["spans"]:
+                for char in span["chars"]:
+                    c = char["c"]
+                    boxes.extend([tuple(char["bbox"])] * len(c))
+                    if c.isspace():
+                        if word:
+                            words.append((*word[:4], "".join(word[4]), word[5], offset))
+                            word = None
+                    else:
+                        x0, y0, x1, y1 = char["bbox"]
+                        if word is None:
+                            word = [x0, y0, x1, y1, [], offset]
+                        else:
+                            word[0] = min(word[0], x0)
+                            word[1] = min(word[1], y0)
+                            word[2] = max(word[2], x1)
+                            word[3] = max(word[3], y1)
+                        word[4].append(c)
+                    parts.append(c)
+                    offset += len(c)
+            if word:
+                words.append((*word[:4], "".join(word[4]), word[5], offset))
+            parts.append("\n")
+            boxes.append(None)
+            offset += 1
+    return PageText(
+        number=page.number,
+        text="".join(parts),
+        words=words,
+        boxes=boxes,
+        line_starts=line_starts,
+    )
+
+
+class DocumentText:
+    """The extracted text of all pages of a document."""
+
+    def __init__(self, pages: list[PageText]):
+        self.pages = pages
+
+    def __getitem__(self, page_number: int) -> PageText:
+        return self.pages[page_number]
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    @property
+    def full_text(self) -> str:
+        return " ".join(page.text for page in self.pages)
+
+
+def _extract_range(pdf_bytes: bytes, start: int, stop: int) -> list[PageText]:
+    doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    return [extract_page(doc[i]) for i in range(start, stop)]
+
+
+def _extract_parallel(doc: Document, workers: int) -> list[PageText]:
+    pdf_bytes = doc.tobytes()
+    with process_pool(workers) as executor:
+        futures = [
+            executor.submit(_extract_range, pdf_bytes, *r) for r in page_ranges(doc.page_count, workers)
+        ]
+        return [page for future in futures for page in future.result()]
+
+
+def extract(doc: Document, workers: int = EXTRACTION_WORKERS) -> DocumentText:
+    """
+    Returns the extracted text of the document, extracting it on first use.
+    The result is cached on the document object (PyMuPDF documents don't support weak references).
+    """
+    cached = getattr(doc, "_auto_redact_text", None)
+    if cached is not None:
+        return cached
+    with stage("extraction"):
+        if workers > 1 and doc.page_count >= EXTRACTION_PARALLEL_MIN_PAGES:
+            pages = _extract_parallel(doc, workers)
+        else:
+            pages = [extract_page(page) for page in doc]
+    document_text = DocumentText(pages)
+    doc._auto_redact_text = document_text
+    return document_text
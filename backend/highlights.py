@@ -0,0 +1,129 @@
+"""
+Highlights in the format of the frontend (react-pdf-highlighter), and their per-document deduplication.
+
+Names usually occur many times in a document. A lookup by text (`page.search_for` or a search in
+the extracted page text) already returns all occurrences on a page, so every (page, text) pair is
+looked up only once, and highlights that have already been emitted are dropped before streaming.
+Highlight IDs are derived from the page and the rectangles, so that they are stable across
+processes and requests.
+"""
+
+import hashlib
+import json
+import re
+from typing import Callable, Iterable
+
+from extraction import PageText
+from pymupdf import Page, Rect
+
+
+def highlight_id(page_number: int, rects: Iterable[Iterable[float]]) -> str:
+    """Deterministic ID of a highlight, derived from its (1-based) page number and rectangles."""
+    key = json.dumps([page_number, [[round(c, 2) for c in rect] for rect in rects]])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def rect_obj(coords, page: Page):
+    return {
+        "x1": coords[0],
+        "y1": coords[1],
+        "x2": coords[2],
+        "y2": coords[3],
+        "width": page.rect.width,
+        "height": page.rect.height,
+        "pageNumber": page.number + 1,
+    }
+
+def bounding_rect(rects: list[Rect]):
+    x1 = min([rect.x0 for rect in rects])
+    y1 = min([rect.y0 for rect in rects])
+    x2 = max([rect.x1 for rect in rects])
+    y2 = max([rect.y1 for rect in rects])
+    return (x1, y1, x2, y2)
+
+def _highlight(page: Page, redact_text: str, ifg_rule: str, matches: list[Rect]):
+    rects = [rect_obj(rect, page) for rect in matches]
+    return {
+        "content": {"text": redact_text},
+        "comment": {"text": "", "emoji": ""},
+        "id": highlight_id(page.number + 1, matches),
+        "position": {
+            "boundingRect": rect_obj(bounding_rect(matches), page),
+            "rects": rects,
+            "pageNumber": page.number + 1,
+        },
+        "ifgRule": ifg_rule,
+    }
+
+
+def get_highlight(page: Page, redact_text: str, ifg_rule: str, context: str | None = None):
+    if context:
+        context_matches = page.search_for(context)
+        if len(context_matches) >= 1:
+            context_rect = bounding_rect(context_matches)
+            matches = page.search_for(redact_text, clip=context_rect)
+        else:
+            matches = page.search_for(redact_text)
+    else:
+        matches = page.search_for(redact_text)
+    if not matches:
+        print(f"Warning: No matches found for '{redact_text}' on page {page.number}")
+    if matches:
+        # print([page.get_textbox(match) for match in matches])
+        return _highlight(page, redact_text, ifg_rule, matches)
+    return None
+
+
+def get_highlight_at(
+    page: Page, page_text: PageText, start: int, end: int, ifg_rule: str
+):
+    """
+    Creates a highlight for the characters between the offsets start and end of the page text,
+    using the character boxes of the extraction instead of searching the page.
+    """
+    matches = page_text.rects(start, end)
+    if not matches:
+        return None
+    return _highlight(page, page_text.text[start:end], ifg_rule, matches)
+
+
+def find_highlight(page: Page, page_text: PageText, redact_text: str, ifg_rule: str):
+    """
+    Creates a highlight for all occurrences of redact_text in the page text.
+    Like `page.search_for`, the search ignores case and differences in whitespace (such as line breaks).
+    Falls back to `page.search_for` if the text does not occur in the extracted page text.
+    """
+    if not redact_text.strip():
+        return None
+    pattern = r"\s+".join(re.escape(word) for word in redact_text.split())
+    matches = [
+        rect
+        for match in re.finditer(pattern, page_text.text, re.IGNORECASE)
+        for rect in page_text.rects(match.start(), match.end())
+    ]
+    if not matches:
+        return get_highlight(page, redact_text, ifg_rule)
+    return _highlight(page, redact_text, ifg_rule, matches)
+
+
+class HighlightDeduplicator:
+    def __init__(self):
+        self._lookups: dict[tuple[int, str], dict | None] = {}
+        self._emitted: set[str] = set()
+
+    def lookup(self, page_number: int, text: str, find: Callable[[], dict | None]) -> dict | None:
+        """
+        Returns the highlight of all occurrences of a text on a page, calling `find` only for the
+        first lookup of the text (ignoring case and whitespace, like the searches themselves).
+        """
+        key = (page_number, " ".join(text.lower().split()))
+        if key not in self._lookups:
+            self._lookups[key] = find()
+        return self._lookups[key]
+
+    def is_new(self, highlight: dict | None) -> bool:
+        """Whether a highlight has not been emitted before; it then counts as emitted."""
+        if highlight is None or highlight["id"] in self._emitted:
+            return False
+        self._emitted.add(highlight["id"])
+        return True
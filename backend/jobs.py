@@ -0,0 +1,288 @@
+"""
+Batch jobs for requests with many attachments, e.g. to pre-process whole request dossiers overnight.
+
+A job is a set of PDFs (uploaded individually or as a ZIP archive) that are analyzed with one prompt
+and engine. The documents of all jobs are queued in a local SQLite database and processed by
+JOB_WORKERS threads; for every document, a draft PDF with the redaction annotations is written.
+Jobs survive restarts: a process renews the claims of the documents it is processing, and documents
+whose claim has not been renewed for JOB_LEASE seconds (because their process has stopped) are queued
+again. This way, several server processes can share the database without taking over each other's documents.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from typing import BinaryIO, Callable, Iterator
+
+from annotations import save_draft
+from fastapi import UploadFile
+from uploads import CHUNK_SIZE, PdfSource, temporary_path
+
+# Directory of the job database and of the input and output PDFs.
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.expanduser("~/.cache/auto-redact/jobs"))
+# Number of documents processed in parallel; 0 disables the processing of jobs.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+POLL_INTERVAL = 1.0
+# Seconds after which a running document whose claim is no longer renewed is queued again.
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+
+_schema = """
+create table if not exists jobs (
+    id text primary key,
+    prompt text not null,
+    engine text not null,
+    created real not null
+);
+create table if not exists documents (
+    job_id text not null references jobs(id),
+    idx integer not null,
+    filename text not null,
+    status text not null default 'pending',  -- pending, running, done or failed
+    highlights integer,
+    error text,
+    updated real not null,
+    primary key (job_id, idx)
+);
+create index if not exists documents_status on documents(status);
+"""
+
+
+def _pdf_uploads(files: list[UploadFile]) -> Iterator[tuple[str, BinaryIO]]:
+    """Yields the filenames and file objects of the PDFs among uploaded PDFs and ZIP archives."""
+    for file in files:
+        if file.filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(file.file) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith(".pdf"):
+                        with archive.open(info) as member:
+                            yield os.path.basename(info.filename), member
+        elif file.filename.lower().endswith(".pdf"):
+            yield file.filename, file.file
+
+
+def _remove_dir(path: str):
+    try:
+        shutil.rmtree(path)
+    except OSError as e:
+        print(f"Warning: Could not remove {path}: {e}")
+
+
+class JobQueue:
+    def __init__(
+        self,
+        analyze: Callable[[PdfSource, str, str], list[dict]],
+        directory: str = JOBS_DIR,
+        workers: int = JOB_WORKERS,
+    ):
+        """`analyze(pdf, prompt, engine)` returns the highlights of a document."""
+        self.analyze = analyze
+        self.directory = directory
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._claimed: set[tuple[str, int]] = set()  # (job_id, idx) of the documents being processed
+        self._claimed_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(_schema)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(os.path.join(self.directory, "jobs.sqlite3"), timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _path(self, job_id: str, idx: int, kind: str) -> str:
+        return os.path.join(self.directory, job_id, f"{idx:05d}.{kind}.pdf")
+
+    def submit(self, files: list[UploadFile], prompt: str, engine: str) -> str | None:
+        """
+        Stores the PDFs of the uploaded files as a new job and returns its ID (None if there are no PDFs).
+        Raises ValueError if a ZIP archive cannot be read.
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.directory, job_id)
+        os.makedirs(job_dir)
+        filenames = []
+        try:
+            for filename, file in _pdf_uploads(files):
+                with open(self._path(job_id, len(filenames), "input"), "wb") as f:
+                    shutil.copyfileobj(file, f, CHUNK_SIZE)
+                filenames.append(filename)
+        except Exception as e:
+            _remove_dir(job_dir)
+            # e.g. corrupt, truncated or encrypted archives
+            if isinstance(e, (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError)):
+                raise ValueError(f"Invalid ZIP archive: {e}") from e
+            raise
+        if not filenames:
+            _remove_dir(job_dir)
+            return None
+        now = time.time()
+        with self._connect() as db:
+            db.execute("insert into jobs values (?, ?, ?, ?)", (job_id, prompt, engine, now))
+            db.executemany(
+                "insert into documents (job_id, idx, filename, updated) values (?, ?, ?, ?)",
+                [(job_id, idx, filename, now) for idx, filename in enumerate(filenames)],
+            )
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_id: str) -> dict | None:
+        with self._connect() as db:
+            job = db.execute("select * from jobs where id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            documents = db.execute(
+                "select idx, filename, status, highlights, error from documents"
+                " where job_id = ? order by idx",
+                (job_id,),
+            ).fetchall()
+        counts = {status: 0 for status in ("pending", "running", "done", "failed")}
+        for document in documents:
+            counts[document["status"]] += 1
+        return {
+            "id": job_id,
+            "prompt": job["prompt"],
+            "engine": job["engine"],
+            "status": "completed" if counts["pending"] + counts["running"] == 0 else "running",
+            **counts,
+            "documents": [dict(document) for document in documents],
+        }
+
+    def progress(self, job_id: str) -> Iterator[str]:
+        """Yields the status of a job as SSE events whenever it changes, until the job is completed."""
+        last = None
+        while (status := self.status(job_id)) is not None:
+            if status != last:
+                yield f"data: {json.dumps(status)}\n\n"
+                last = status
+            if status["status"] == "completed":
+                break
+            time.sleep(POLL_INTERVAL)
+
+    def archive(self, job_id: str) -> str:
+        """Writes the draft PDFs of the processed documents of a job to a temporary ZIP file and returns its path."""
+        status = self.status(job_id)
+        path = temporary_path(".zip")
+        names = set()
+        # PDFs hardly compress any further
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+            for document in status["documents"]:
+                if document["status"] != "done":
+                    continue
+                stem, ext = os.path.splitext(document["filename"])
+                name = f"{stem}_redaction_draft{ext}"
+                if name in names:  # attachments with the same name
+                    name = f"{stem}_{document['idx']}_redaction_draft{ext}"
+                names.add(name)
+                archive.write(self._path(job_id, document["idx"], "draft"), name)
+        return path
+
+    def _claim(self) -> sqlite3.Row | None:
+        """Marks the oldest pending document as running and returns it."""
+        now = time.time()
+        with self._connect() as db:
+            # documents of processes that have stopped, e.g. when the server was restarted
+            db.execute(
+                "update documents set status = 'pending' where status = 'running' and updated < ?",
+                (now - JOB_LEASE,),
+            )
+            document = db.execute(
+                """
+                update documents set status = 'running', updated = ?
+                where rowid = (
+                    select documents.rowid from documents join jobs on jobs.id = documents.job_id
+                    where status = 'pending' order by jobs.created, idx limit 1
+                )
+                returning job_id, idx,
+                    (select prompt from jobs where id = job_id) as prompt,
+                    (select engine from jobs where id = job_id) as engine
+                """,
+                (now,),
+            ).fetchone()
+        if document is not None:
+            with self._claimed_lock:
+                self._claimed.add((document["job_id"], document["idx"]))
+        return document
+
+    def _renew(self):
+        """Keeps the claims of the documents being processed by this process from expiring."""
+        while True:
+            time.sleep(JOB_LEASE / 4)
+            with self._claimed_lock:
+                claimed = list(self._claimed)
+            if not claimed:
+                continue
+            try:
+                with self._connect() as db:
+                    db.executemany(
+                        "update documents set updated = ? where job_id = ? and idx = ? and status = 'running'",
+                        [(time.time(), job_id, idx) for job_id, idx in claimed],
+                    )
+            except sqlite3.Error as e:
+                print(f"Warning: Could not renew the claims of job documents: {e}")
+
+    def _finish(self, document: sqlite3.Row, highlights: int | None = None, error: str | None = None):
+        with self._claimed_lock:
+            self._claimed.discard((document["job_id"], document["idx"]))
+        with self._connect() as db:
+            db.execute(
+                "update documents set status = ?, highlights = ?, error = ?, updated = ?"
+                " where job_id = ? and idx = ?",
+                (
+                    "failed" if error else "done",
+                    highlights,
+                    error,
+                    time.time(),
+                    document["job_id"],
+                    document["idx"],
+                ),
+            )
+
+    def _process(self, document: sqlite3.Row) -> int:
+        source = PdfSource(path=self._path(document["job_id"], document["idx"], "input"))
+        highlights = self.analyze(source, document["prompt"], document["engine"])
+        draft = save_draft(source, highlights)
+        shutil.move(draft, self._path(document["job_id"], document["idx"], "draft"))
+        return len(highlights)
+
+    def _work(self):
+        while True:
+            document = self._claim()
+            if document is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            try:
+                self._finish(document, highlights=self._process(document))
+            except Exception as e:
+                print(f"Warning: Job document {document['job_id']}/{document['idx']} failed: {e}")
+                self._finish(document, error=f"{type(e).__name__}: {e}")
+
+    def start(self):
+        """Starts the worker threads that process the queued documents."""
+        if self.workers > 0 and not self._threads:
+            threading.Thread(target=self._renew, daemon=True).start()
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+
+_job_queue: JobQueue | None = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue(analyze: Callable[[PdfSource, str, str], list[dict]]) -> JobQueue:
+    """Returns the shared job queue, creating it on first use."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(analyze)
+        return _job_queue
@@ -0,0 +1,76 @@
+"""
+Language detection for routing pages to the per-language NER models.
+
+Instead of running `langdetect` over the whole document, the document language is detected on
+a bounded sample of text taken from pages spread across the document. Optionally, the language
+is detected for every page, so that mixed German/English documents are tagged with the matching
+model; pages with too little text use the document language.
+"""
+
+import os
+from typing import Container
+
+from extraction import DocumentText
+from langdetect import DetectorFactory, LangDetectException, detect
+from metrics import stage
+
+# "document" detects one language for the whole document, "page" one language per page.
+LANG_DETECT_MODE = os.getenv("LANG_DETECT_MODE", "document")
+# Maximum number of characters that are passed to langdetect at once.
+LANG_DETECT_MAX_CHARS = int(os.getenv("LANG_DETECT_MAX_CHARS", "5000"))
+# Pages with less text than this use the language of the document.
+LANG_DETECT_MIN_CHARS = int(os.getenv("LANG_DETECT_MIN_CHARS", "200"))
+
+DetectorFactory.seed = 0  # make the results deterministic
+
+
+def detection_settings() -> dict:
+    """The settings of the language detection (they decide which model tags a page)."""
+    return {
+        "mode": LANG_DETECT_MODE,
+        "max_chars": LANG_DETECT_MAX_CHARS,
+        "min_chars": LANG_DETECT_MIN_CHARS,
+    }
+
+
+def sample_text(doc_text: DocumentText, max_chars: int = LANG_DETECT_MAX_CHARS) -> str:
+    """Takes up to max_chars characters, in equal parts from pages spread evenly across the document."""
+    pages = [page.text for page in doc_text if page.text.strip()]
+    if not pages:
+        return ""
+    n_samples = max(1, min(len(pages), max_chars // LANG_DETECT_MIN_CHARS))
+    chars_per_sample = max_chars // n_samples
+    step = len(pages) / n_samples
+    return " ".join(pages[int(i * step)][:chars_per_sample] for i in range(n_samples))
+
+
+def detect_language(text: str, supported: Container[str] | None, default: str) -> str:
+    try:
+        lang = detect(text)
+    except LangDetectException:  # e.g. no text at all
+        return default
+    if supported is not None and lang not in supported:
+        return default
+    return lang
+
+
+def page_languages(
+    doc_text: DocumentText,
+    supported: Container[str] | None,
+    default: str,
+    mode: str = LANG_DETECT_MODE,
+) -> list[str]:
+    """
+    Returns the language of each page. Languages that are not supported are replaced by the default.
+    `supported=None` accepts any detected language.
+    """
+    with stage("language_detection"):
+        doc_lang = detect_language(sample_text(doc_text), supported, default)
+        if mode != "page":
+            return [doc_lang] * len(doc_text)
+        return [
+            detect_language(page.text[:LANG_DETECT_MAX_CHARS], supported, doc_lang)
+            if len(page.text.strip()) >= LANG_DETECT_MIN_CHARS
+            else doc_lang
+            for page in doc_text
+        ]
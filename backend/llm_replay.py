@@ -0,0 +1,95 @@
+"""
+Record/replay stand-ins for `litellm.completion`, for testing and benchmarking without an LLM.
+
+A recording is a JSONL file with one streamed chunk per line ({"content": ..., "finish_reason": ...}).
+Recordings are stored in a directory under the SHA-256 of model and prompt, so that a replay
+returns the response that was recorded for the same request. A single recording file can also be
+replayed for every request, e.g. for throughput benchmarks.
+
+Set LLM_RECORD=<directory> to record all completions of the app, and LLM_REPLAY=<directory or file>
+to replay them instead of calling the LLM.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+from typing import Callable, Generator
+
+
+def recording_path(directory: str, model: str, messages: list[dict]) -> str:
+    key = hashlib.sha256(json.dumps([model, messages]).encode("utf-8")).hexdigest()
+    return os.path.join(directory, f"{key}.jsonl")
+
+
+def _chunk(content: str | None, finish_reason: str | None):
+    """Builds an object that looks like a streamed chunk of `litellm.completion`."""
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+
+def recording_completion(completion: Callable, directory: str) -> Callable:
+    """Wraps a streaming completion function so that all responses are written to the directory."""
+    os.makedirs(directory, exist_ok=True)
+
+    def record(model: str, messages: list[dict], **kwargs) -> Generator:
+        path = recording_path(directory, model, messages)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            for chunk in completion(model=model, messages=messages, **kwargs):
+                choice = chunk.choices[0]
+                f.write(
+                    json.dumps(
+                        {"content": choice.delta.content, "finish_reason": choice.finish_reason}
+                    )
+                    + "\n"
+                )
+                yield chunk
+        os.replace(f"{path}.tmp", path)
+
+    return record
+
+
+def replay_completion(path: str, delay: float = 0.0) -> Callable:
+    """
+    Returns a completion function that replays recordings from a directory (matched by model
+    and prompt) or a single recording file (for every request), optionally with a delay per chunk.
+    """
+
+    def replay(model: str, messages: list[dict], **kwargs) -> Generator:
+        file = path if os.path.isfile(path) else recording_path(path, model, messages)
+        if not os.path.exists(file):
+            raise FileNotFoundError(f"No recorded completion for this request in {path}")
+        with open(file, "r", encoding="utf-8") as f:
+            for line in f:
+                if delay:
+                    time.sleep(delay)
+                chunk = json.loads(line)
+                yield _chunk(chunk["content"], chunk["finish_reason"])
+
+    return replay
+
+
+def benchmark(recording: str, pdf_path: str):
+    """Measures parsing and highlight throughput for a recorded response on a PDF."""
+    import pymupdf
+
+    import processing_ai
+
+    processing_ai.completion = replay_completion(recording)
+    doc = pymupdf.open(pdf_path)
+    start = time.perf_counter()
+    events = list(processing_ai.process_pdf_streaming(doc, "")())
+    duration = time.perf_counter() - start
+    with open(recording, "r", encoding="utf-8") as f:
+        n_chunks = sum(1 for _ in f)
+    print(f"{n_chunks} chunks, {len(events) - 2} highlights in {duration:.3f}s")
+    print(f"{n_chunks / duration:.0f} chunks/s, {(len(events) - 2) / duration:.0f} highlights/s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python llm_replay.py <recording.jsonl> <document.pdf>")
+        sys.exit(1)
+    benchmark(sys.argv[1], sys.argv[2])
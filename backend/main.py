@@ -2,13 +2,15 @@
 # - https://pymupdf.readthedocs.io/en/latest/page.html#Page.add_redact_annot
 # - https://pymupdf.readthedocs.io/en/latest/annot.html
 
-import base64
-import io
+import itertools
 import json
 import os
+import queue
+import time
+import uuid
+from contextlib import asynccontextmanager
 from typing import Literal, cast
 
-import pymupdf
 from fastapi import (
     APIRouter,
     FastAPI,
@@ -19,14 +21,97 @@ from fastapi import (
     UploadFile,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-# from processing_ai import process_pdf_streaming
-from processing_ner_flair import process_pdf_streaming
-from annotations import apply_annotations, convert_annotations_to_highlights
+from annotations import (
+    apply_annotations,
+    apply_annotations_sharded,
+    convert_annotations_to_highlights,
+    iter_annotations_to_highlights,
+    save_draft,
+    use_sharding,
+)
+from cache import analysis_cache, cache_key
+import engines
+import jobs
+import metrics
+import worker_pool
 from pymupdf import Document
+from starlette.background import BackgroundTask
+from sessions import sessions
+from uploads import PdfSource, Upload, read_file, remove_file
+
+# Engine of requests that don't select one (the engine of the worker pool, if it is enabled)
+ENGINE = worker_pool.NER_ENGINE if worker_pool.NER_WORKERS else engines.DEFAULT_ENGINE
+
+# Languages whose models are loaded before the app starts serving (comma-separated, e.g. "de,en")
+PRELOAD_LANGUAGES = [
+    lang.strip() for lang in os.getenv("PRELOAD_LANGUAGES", "").split(",") if lang.strip()
+]
+models_ready = False
+
+
+def preload_models():
+    """Loads the models of the default engine for PRELOAD_LANGUAGES (in this process, or in the worker pool)."""
+    global models_ready
+    if worker_pool.NER_WORKERS:
+        worker_pool.get_pool()  # the workers load their models in the background
+    else:
+        engines.get_engine(ENGINE).preload(PRELOAD_LANGUAGES)
+    models_ready = True
+
+
+def use_pool(engine: str) -> bool:
+    """Whether an engine runs in the worker pool (only the engine of the pool does)."""
+    return bool(worker_pool.NER_WORKERS) and engine == worker_pool.NER_ENGINE
+
+
+def select_engine(engine: str | None) -> str:
+    """Returns the engine requested by a client (default: ENGINE), rejecting unknown engines."""
+    engine = engine or ENGINE
+    if engine not in engines.ENGINES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown engine: {engine} (available: {', '.join(engines.ENGINES)})",
+        )
+    return engine
 
-app = FastAPI()
+
+def analysis_highlights(source: PdfSource, prompt: str, engine: str) -> list[dict]:
+    """Analyzes a PDF of a batch job (or takes the result from the cache) and returns its highlights."""
+    key = cache_key(source.sha256(), engine, prompt, engines.cache_tag(engine))
+    events = analysis_cache.get(key)
+    if events is None:
+        if use_pool(engine):
+            while True:
+                try:
+                    generate = worker_pool.get_pool().submit(source.source, prompt)
+                    break
+                except queue.Full:
+                    time.sleep(jobs.POLL_INTERVAL)  # wait for a free worker
+        else:
+            generate = engines.get_engine(engine).process_pdf_streaming(source.open(), prompt)
+        events = list(analysis_cache.record(key, generate()))
+    return [
+        json.loads(event.removeprefix("data: "))
+        for event in events
+        if not event.startswith('data: {"status":')
+    ]
+
+
+def job_queue() -> jobs.JobQueue:
+    return jobs.get_job_queue(analysis_highlights)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(preload_models)
+    job_queue().start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 api_router = APIRouter()
 
 # Add CORS middleware
@@ -39,17 +124,99 @@ app.add_middleware(
 )
 
 
-@api_router.post("/analyze-pdf")
-def analyze_pdf(file: UploadFile, prompt: str = Form(...)):
+def pdf_source(file: UploadFile | None, session_id: str | None) -> tuple[PdfSource, str]:
+    """Returns the PDF of a request and its filename, either from the uploaded file or from the session."""
+    if session_id:
+        session = sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found or expired")
+        return session, session.filename
+    if file is None:
+        raise HTTPException(status_code=400, detail="Either a file or a session ID is required")
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="File must be a PDF")
+    # Read the PDF file (into memory, or onto disk if it is large)
+    return Upload(file), file.filename
 
-    contents = file.file.read()
-    pdf_stream = io.BytesIO(contents)
-    doc = pymupdf.open(stream=pdf_stream, filetype="pdf")
 
+def cleanup(source: PdfSource, *paths: str):
+    source.close()
+    for path in paths:
+        remove_file(path)
+
+
+@api_router.post("/analyze-pdf")
+def analyze_pdf(
+    file: UploadFile | None = File(None),
+    prompt: str = Form(...),
+    session_id: str | None = Form(None),
+    include_timings: bool = Form(False),
+    engine: str | None = Form(None),
+):
+    engine = select_engine(engine)
+    # per-stage timings of this request, optionally sent along with the final event
+    timings = metrics.new_timings()
+    start = time.perf_counter()
+    with metrics.recording(timings):
+        upload, _ = pdf_source(file, session_id)
+
+        key = cache_key(upload.sha256(), engine, prompt, engines.cache_tag(engine))
+        cached_events = analysis_cache.get(key)
+        if cached_events is not None:
+            upload.close()
+            events = iter(cached_events)
+            if include_timings:
+                events = metrics.with_timings(events, timings)
+            return StreamingResponse(events, media_type="text/event-stream")
+
+        if use_pool(engine):
+            try:
+                events = worker_pool.get_pool().submit(upload.source, prompt)
+            except queue.Full:
+                upload.close()
+                raise HTTPException(
+                    status_code=503, detail="Too many documents in the queue, please retry later"
+                )
+            except RuntimeError as e:  # no worker is left
+                upload.close()
+                raise HTTPException(status_code=503, detail=str(e))
+        else:
+            doc = upload.open()
+            timings["pages"] = doc.page_count
+            events = engines.get_engine(engine).process_pdf_streaming(doc, prompt)
+
+    events = analysis_cache.record(key, metrics.track(events(), engine, timings, start))
+    if include_timings:
+        events = metrics.with_timings(events, timings)
     return StreamingResponse(
-        process_pdf_streaming(doc, prompt)(), media_type="text/event-stream"
+        events,
+        media_type="text/event-stream",
+        background=BackgroundTask(upload.close),
+    )
+
+
+@api_router.get("/ready")
+def ready():
+    """Readiness probe: succeeds once the models are loaded and requests are served without delay."""
+    is_ready = models_ready and (
+        not worker_pool.NER_WORKERS or worker_pool.get_pool().ready
+    )
+    return JSONResponse(
+        {
+            "ready": is_ready,
+            "engine": ENGINE,
+            "engines": list(engines.ENGINES),
+            "languages": PRELOAD_LANGUAGES,
+        },
+        status_code=200 if is_ready else 503,
+    )
+
+
+@api_router.get("/metrics")
+def get_metrics():
+    """Per-stage timings, analysis latencies and cache statistics in the Prometheus text format."""
+    return PlainTextResponse(
+        metrics.prometheus(analysis_cache.stats()), media_type="text/plain; version=0.0.4"
     )
 
 
@@ -60,6 +227,39 @@ def safe_filename(filename: str) -> str:
     ).strip()
 
 
+def multipart_response(
+    parts: list[tuple[str, str, bytes | str, str | None]], background: BackgroundTask | None = None
+) -> StreamingResponse:
+    """
+    Streams (name, content type, content, filename) parts as multipart/form-data,
+    which the browser parses with `Response.formData()`, without copying the contents.
+    The content is either bytes or the path of a file, which is streamed in chunks.
+    """
+    boundary = uuid.uuid4().hex
+    chunks = []
+    length = 0
+    for name, content_type, content, filename in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename:
+            disposition += f'; filename="{filename}"'
+        header = (
+            f"--{boundary}\r\nContent-Disposition: {disposition}\r\n"
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8")
+        )
+        chunks += [[header], read_file(content) if isinstance(content, str) else [content], [b"\r\n"]]
+        length += len(header) + 2
+        length += os.path.getsize(content) if isinstance(content, str) else len(content)
+    trailer = f"--{boundary}--\r\n".encode("utf-8")
+    chunks.append([trailer])
+    length += len(trailer)
+    return StreamingResponse(
+        itertools.chain.from_iterable(chunks),
+        media_type=f"multipart/form-data; boundary={boundary}",
+        headers={"Content-Length": str(length)},
+        background=background,
+    )
+
+
 @api_router.post("/upload-pdf")
 def upload_pdf(file: UploadFile = File(...)):
     """
@@ -68,62 +268,163 @@ def upload_pdf(file: UploadFile = File(...)):
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="File must be a PDF")
 
-    # Read the PDF file
-    contents = file.file.read()
-    pdf_stream = io.BytesIO(contents)
-    doc = pymupdf.open(stream=pdf_stream, filetype="pdf")
+    # Read the PDF file (into memory, or onto disk if it is large)
+    upload = Upload(file)
+    doc = upload.open()
 
     # Convert annotations to highlights for the frontend
     highlights = convert_annotations_to_highlights(doc)
 
-    # Convert PDF to base64 for JSON response
-    pdf_bytes = doc.tobytes(garbage=1)
-    pdf_base64 = base64.b64encode(pdf_bytes).decode("ascii")
-
-    return Response(
-        content=json.dumps(
-            {
-                "pdf": pdf_base64,
-                "highlights": highlights,
-            }
-        ),
-        media_type="application/json",
+    # Only rewrite the PDF if annotations have been removed
+    pdf = upload.save(doc, garbage=1) if highlights else upload.take_source()
+
+    # Keep the cleaned PDF, so that analysis and download can refer to it by the session ID
+    session = sessions.create(pdf, file.filename)
+
+    # Send the PDF as raw bytes next to the highlights, rather than base64-encoded inside JSON
+    return multipart_response(
+        [
+            ("session", "text/plain", session.id.encode("utf-8"), None),
+            ("highlights", "application/json", json.dumps(highlights).encode("utf-8"), None),
+            ("pdf", "application/pdf", session.source, safe_filename(file.filename)),
+        ],
+        background=BackgroundTask(upload.close),
     )
 
 
+@api_router.post("/upload-pdf-stream")
+def upload_pdf_stream(file: UploadFile = File(...)):
+    """
+    Like /upload-pdf, but streams the existing redaction annotations as server-sent events page by page,
+    so that they can be shown before the whole document has been converted. The last event contains the
+    session ID, under which the cleaned PDF can be fetched from /session-pdf.
+    """
+    if not file.filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="File must be a PDF")
+
+    upload = Upload(file)
+    doc = upload.open()
+
+    def generate():
+        yield f"data: {json.dumps({'status': 'started', 'pageCount': doc.page_count})}\n\n"
+        removed_annotations = False
+        for highlights in iter_annotations_to_highlights(doc):
+            removed_annotations = removed_annotations or bool(highlights)
+            for highlight in highlights:
+                yield f"data: {json.dumps(highlight)}\n\n"
+        # Only rewrite the PDF if annotations have been removed
+        pdf = upload.save(doc, garbage=1) if removed_annotations else upload.take_source()
+        session = sessions.create(pdf, file.filename)
+        yield f"data: {json.dumps({'status': 'completed', 'session': session.id})}\n\n"
+
+    return StreamingResponse(
+        generate(), media_type="text/event-stream", background=BackgroundTask(upload.close)
+    )
+
+
+@api_router.get("/session-pdf")
+def session_pdf(session_id: str):
+    """Returns the cleaned PDF of a session."""
+    session, filename = pdf_source(None, session_id)
+    headers = {"Content-Disposition": f"attachment; filename={safe_filename(filename)}"}
+    if session.in_memory:
+        return Response(content=session.data, media_type="application/pdf", headers=headers)
+    return FileResponse(session.path, media_type="application/pdf", headers=headers)
+
+
 @api_router.post("/download-pdf")
 def download_pdf(
-    file: UploadFile = File(...),
+    file: UploadFile | None = File(None),
     annotations: str = Form(...),
     mode: Literal["draft", "final"] = Form("final"),
+    session_id: str | None = Form(None),
 ):
     """
     Converts highlights from the frontend to (draft/final) redaction annotations.
     """
-    if not file.filename.endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="File must be a PDF")
+    upload, original_filename = pdf_source(file, session_id)
 
     # Parse the annotations JSON string
     highlights = json.loads(annotations)
 
-    # Read the PDF file
-    contents = file.file.read()
-    pdf_stream = io.BytesIO(contents)
-    doc = pymupdf.open(stream=pdf_stream, filetype="pdf")
-    doc = cast(Document, doc)
-
     # Convert annotations to (draft) redactions
-    apply_annotations(doc, highlights, mode)
+    if mode == "draft":
+        # drafts are appended to the original file as an incremental update
+        pdf = save_draft(upload, highlights)
+    else:
+        doc = cast(Document, upload.open())
+        if use_sharding(doc, mode):
+            doc = apply_annotations_sharded(upload.source, highlights)
+        else:
+            apply_annotations(doc, highlights, mode)
+        pdf = upload.save(doc, garbage=1)
 
-    filename, ext = os.path.splitext(safe_filename(file.filename))
+    filename, ext = os.path.splitext(safe_filename(original_filename))
     filename = (
         f"{filename}{'_redaction_draft' if mode == 'draft' else '_redacted'}{ext}"
     )
 
-    return Response(
-        content=doc.tobytes(garbage=1),
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    if isinstance(pdf, str):
+        # large documents are streamed from a temporary file
+        return FileResponse(
+            pdf,
+            media_type="application/pdf",
+            headers=headers,
+            background=BackgroundTask(cleanup, upload, pdf),
+        )
+    upload.close()
+    return Response(content=pdf, media_type="application/pdf", headers=headers)
+
+
+@api_router.post("/jobs")
+def submit_job(
+    files: list[UploadFile] = File(...),
+    prompt: str = Form(...),
+    engine: str | None = Form(None),
+):
+    """
+    Queues PDFs (or ZIP archives of PDFs) for analysis as a batch job. The draft PDFs can be
+    downloaded from /jobs/{job_id}/download once the job has been processed.
+    """
+    try:
+        job_id = job_queue().submit(files, prompt, select_engine(engine))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if job_id is None:
+        raise HTTPException(status_code=400, detail="No PDF files found")
+    return {"id": job_id}
+
+
+def job_status(job_id: str) -> dict:
+    status = job_queue().status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+
+@api_router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return job_status(job_id)
+
+
+@api_router.get("/jobs/{job_id}/events")
+def job_events(job_id: str):
+    """Streams the status of a job whenever it changes, until all documents have been processed."""
+    job_status(job_id)
+    return StreamingResponse(job_queue().progress(job_id), media_type="text/event-stream")
+
+
+@api_router.get("/jobs/{job_id}/download")
+def download_job(job_id: str):
+    """Returns the draft PDFs of the processed documents of a job as a ZIP archive."""
+    job_status(job_id)
+    path = job_queue().archive(job_id)
+    return FileResponse(
+        path,
+        media_type="application/zip",
+        filename=f"{job_id}.zip",
+        background=BackgroundTask(remove_file, path),
     )
 
 
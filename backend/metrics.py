@@ -0,0 +1,164 @@
+"""
+Lightweight timing of the stages of the pipeline, and aggregated metrics in the Prometheus text format.
+
+Code on the hot path measures its stages with `with stage("inference"): ...`. The durations are added
+to the totals of the process and, while an analysis is being recorded (see `recording` and `track`),
+to the timings of that analysis, which can be sent along with its final SSE event. /api/metrics exports
+the totals per stage, a latency histogram of the analyses per engine and page count, and cache statistics.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Iterator
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+PAGE_BUCKETS = ((1, "1"), (10, "2-10"), (100, "11-100"), (1000, "101-1000"))
+
+_timings: ContextVar[dict | None] = ContextVar("timings", default=None)
+_lock = threading.Lock()
+_stage_seconds: dict[str, float] = defaultdict(float)
+_stage_calls: dict[str, int] = defaultdict(int)
+# (engine, page bucket) -> [counts per latency bucket (incl. +Inf), sum of durations]
+_latencies: dict[tuple[str, str], list] = {}
+
+
+def new_timings(pages: int | None = None) -> dict:
+    return {"pages": pages, "seconds": None, "stages": {}}
+
+
+def _add(name: str, seconds: float, count: int = 1):
+    with _lock:
+        _stage_seconds[name] += seconds
+        _stage_calls[name] += count
+    timings = _timings.get()
+    if timings is not None:
+        entry = timings["stages"].setdefault(name, {"seconds": 0.0, "count": 0})
+        entry["seconds"] += seconds
+        entry["count"] += count
+
+
+@contextmanager
+def stage(name: str):
+    """Measures the duration of a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add(name, time.perf_counter() - start)
+
+
+@contextmanager
+def recording(timings: dict):
+    """Adds the stages measured in this context to `timings`."""
+    token = _timings.set(timings)
+    try:
+        yield
+    finally:
+        _timings.reset(token)
+
+
+def page_bucket(pages: int | None) -> str:
+    if pages is None:
+        return "unknown"
+    for limit, label in PAGE_BUCKETS:
+        if pages <= limit:
+            return label
+    return f">{PAGE_BUCKETS[-1][0]}"
+
+
+def _observe(engine: str, pages: int | None, seconds: float):
+    with _lock:
+        counts = _latencies.setdefault((engine, page_bucket(pages)), [[0] * (len(LATENCY_BUCKETS) + 1), 0.0])
+        for i, limit in enumerate(LATENCY_BUCKETS):
+            if seconds <= limit:
+                counts[0][i] += 1
+        counts[0][-1] += 1
+        counts[1] += seconds
+
+
+def track(
+    events: Iterable[str], engine: str, timings: dict, start: float | None = None
+) -> Iterator[str]:
+    """
+    Records the stages of an analysis into `timings` while its SSE events are generated, and adds its
+    duration (since `start`, by default the first event) to the latency histogram. Timings sent along
+    by a worker process (see `with_timings`) are taken over and removed from the final event.
+    """
+    start = start or time.perf_counter()
+    iterator = iter(events)
+    while True:
+        # every step may run in another thread of the server, so the context is set for each of them
+        with recording(timings):
+            event = next(iterator, None)
+            if event is None:
+                break
+            if event.startswith('data: {"status": "completed"'):
+                data = json.loads(event.removeprefix("data: "))
+                if "timings" in data:
+                    worker_timings = data.pop("timings")
+                    timings["pages"] = timings["pages"] or worker_timings["pages"]
+                    for name, entry in worker_timings["stages"].items():
+                        _add(name, entry["seconds"], entry["count"])
+                    event = f"data: {json.dumps(data)}\n\n"
+        if event.startswith('data: {"status": "completed"'):
+            timings["seconds"] = time.perf_counter() - start
+            _observe(engine, timings["pages"], timings["seconds"])
+        yield event
+
+
+def with_timings(events: Iterable[str], timings: dict) -> Iterator[str]:
+    """Adds the timings of an analysis to its final SSE event."""
+    for event in events:
+        if event.startswith('data: {"status": "completed"'):
+            data = json.loads(event.removeprefix("data: "))
+            event = f"data: {json.dumps({**data, 'timings': timings})}\n\n"
+        yield event
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def prometheus(cache_stats: dict | None = None) -> str:
+    """Renders the aggregated metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP auto_redact_stage_seconds_total Time spent in each stage of the pipeline.",
+        "# TYPE auto_redact_stage_seconds_total counter",
+    ]
+    with _lock:
+        stage_seconds = dict(_stage_seconds)
+        stage_calls = dict(_stage_calls)
+        latencies = {key: (list(counts), total) for key, (counts, total) in _latencies.items()}
+    for name, seconds in sorted(stage_seconds.items()):
+        lines.append(f"auto_redact_stage_seconds_total{_labels(stage=name)} {seconds:.6f}")
+    lines += [
+        "# HELP auto_redact_stage_calls_total Number of times each stage of the pipeline has run.",
+        "# TYPE auto_redact_stage_calls_total counter",
+    ]
+    for name, calls in sorted(stage_calls.items()):
+        lines.append(f"auto_redact_stage_calls_total{_labels(stage=name)} {calls}")
+    lines += [
+        "# HELP auto_redact_analysis_seconds Duration of analyses per engine and page count.",
+        "# TYPE auto_redact_analysis_seconds histogram",
+    ]
+    for (engine, pages), (counts, total) in sorted(latencies.items()):
+        for limit, count in zip([*LATENCY_BUCKETS, "+Inf"], counts):
+            lines.append(
+                f"auto_redact_analysis_seconds_bucket{_labels(engine=engine, pages=pages, le=limit)} {count}"
+            )
+        lines.append(f"auto_redact_analysis_seconds_sum{_labels(engine=engine, pages=pages)} {total:.6f}")
+        lines.append(f"auto_redact_analysis_seconds_count{_labels(engine=engine, pages=pages)} {counts[-1]}")
+    if cache_stats is not None:
+        lines += [
+            "# TYPE auto_redact_cache_hits_total counter",
+            f"auto_redact_cache_hits_total {cache_stats['hits']}",
+            "# TYPE auto_redact_cache_misses_total counter",
+            f"auto_redact_cache_misses_total {cache_stats['misses']}",
+            "# TYPE auto_redact_cache_entries gauge",
+            f"auto_redact_cache_entries {cache_stats['entries']}",
+        ]
+    return "\n".join(lines) + "\n"
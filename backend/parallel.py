@@ -0,0 +1,22 @@
+"""
+Helpers for spreading the work on documents across worker processes.
+"""
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+
+def spawn_context():
+    # "spawn" because torch and its thread pools are not fork-safe once they are initialized
+    return mp.get_context("spawn")
+
+
+def process_pool(workers: int, **kwargs) -> ProcessPoolExecutor:
+    """Returns a pool of `workers` spawned processes (see `ProcessPoolExecutor` for the options)."""
+    return ProcessPoolExecutor(workers, mp_context=spawn_context(), **kwargs)
+
+
+def page_ranges(page_count: int, parts: int) -> list[tuple[int, int]]:
+    """Splits the pages into at most `parts` contiguous ranges (start, stop) of about equal size."""
+    step = max(1, -(-page_count // max(1, parts)))  # ceiling division
+    return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
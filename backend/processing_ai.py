@@ -1,80 +1,51 @@
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 from typing import Generator
 
 from dotenv import load_dotenv
+from extraction import DocumentText, extract
+from highlights import HighlightDeduplicator, find_highlight
 from litellm import completion
-from pymupdf import Document, Page, Rect
+from llm_replay import recording_completion, replay_completion
+from metrics import stage
+from pymupdf import Document
+from redact_parser import parse_completion
+from rules import ifg_rules, ifg_text
 
 load_dotenv(override=True)
 
-with open("../rules/informationsfreiheitsgesetz.json", "r", encoding="utf-8") as f:
-    ifg_rules = json.load(f)["rules"]
-ifg_text = "\n\n".join(
-    [f"{rule['reference']}: {rule['title']}\n{rule['full_text']}" for rule in ifg_rules]
-)
-
-def rect_obj(coords, page: Page):
-    return {
-        "x1": coords[0],
-        "y1": coords[1],
-        "x2": coords[2],
-        "y2": coords[3],
-        "width": page.rect.width,
-        "height": page.rect.height,
-        "pageNumber": page.number + 1,
-    }
-
-def bounding_rect(rects: list[Rect]):
-    x1 = min([rect.x0 for rect in rects])
-    y1 = min([rect.y0 for rect in rects])
-    x2 = max([rect.x1 for rect in rects])
-    y2 = max([rect.y1 for rect in rects])
-    return (x1, y1, x2, y2)
-
-def get_highlight(page: Page, redact_text: str, ifg_rule: str, context: str | None = None):
-    if context:
-        context_matches = page.search_for(context)
-        if len(context_matches) >= 1:
-            context_rect = bounding_rect(context_matches)
-            matches = page.search_for(redact_text, clip=context_rect)
-        else:
-            matches = page.search_for(redact_text)
-    else:
-        matches = page.search_for(redact_text)
-    if not matches:
-        print(f"Warning: No matches found for '{redact_text}' on page {page.number}")
-    if matches:
-        rects = [rect_obj(rect, page) for rect in matches]
-        # print([page.get_textbox(match) for match in matches])
-        highlight = {
-            "content": {"text": redact_text},
-            "comment": {"text": "", "emoji": ""},
-            "id": hash(str(rects)),
-            "position": {
-                "boundingRect": rect_obj(bounding_rect(matches), page),
-                "rects": rects,
-                "pageNumber": page.number + 1,
-            },
-            "ifgRule": ifg_rule,
-        }
-        return highlight
-    return None
+if os.getenv("LLM_REPLAY"):
+    completion = replay_completion(os.getenv("LLM_REPLAY"))
+elif os.getenv("LLM_RECORD"):
+    completion = recording_completion(completion, os.getenv("LLM_RECORD"))
 
+# Token budget for the page text of a single completion; 0 sends the whole document at once.
+LLM_WINDOW_TOKENS = int(os.getenv("LLM_WINDOW_TOKENS", "0"))
+# Maximum number of completions that run at the same time.
+LLM_PARALLELISM = int(os.getenv("LLM_PARALLELISM", "4"))
+# Retries of a failed completion of a window (e.g. after rate limiting), with exponential backoff.
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_DELAY = float(os.getenv("LLM_RETRY_DELAY", "2"))
+CHARS_PER_TOKEN = 4  # rough estimate for German and English text
+LLM_MODEL = os.getenv("LLM_MODEL", "azure/gpt-4o-mini")
 
-def process_pdf_streaming(
-    doc: Document, prompt: str, verbose: bool = False, model="azure/gpt-4o-mini"
-) -> Generator:
-    # Collect all pages with page numbers
-    all_pages_text = []
-    for page_num, page in enumerate(doc, 1):
-        page_text = page.get_text()
-        all_pages_text.append(f"=== PAGE {page_num} ===\n{page_text}")
+def preload(langs: list[str]) -> None:
+    """Nothing to load ahead of time, the model runs remotely."""
 
-    combined_text = "\n\n".join(all_pages_text)
 
-    full_prompt = dedent(f"""
+def cache_tag() -> str:
+    """Fingerprint of the settings that change the results (part of the cache key)."""
+    return json.dumps(
+        {"model": LLM_MODEL, "window_tokens": LLM_WINDOW_TOKENS, "chars_per_token": CHARS_PER_TOKEN},
+        sort_keys=True,
+    )
+
+
+def build_prompt(prompt: str, text: str, text_info: str) -> str:
+    return dedent(f"""
     <BACKGROUND>
     Informationsfreiheitsgesetz (IFG)
     {ifg_text}
@@ -156,76 +127,139 @@ def process_pdf_streaming(
     "{prompt}"
     </USER_PROMPT>
     <TEXT_TO_ANALYZE>
-    Text to analyze ({doc.page_count} pages):
-    {combined_text}
+    Text to analyze ({text_info}):
+    {text}
     </TEXT_TO_ANALYZE>
     """)
 
+
+def page_windows(doc_text: DocumentText, window_tokens: int) -> list[list[int]]:
+    """
+    Splits the (0-based) page numbers into consecutive windows whose text fits into the token budget.
+    A page that exceeds the budget on its own gets a window of its own. A budget of 0 means a single window.
+    """
+    windows = []
+    window, window_size = [], 0
+    for page_text in doc_text:
+        size = len(page_text.text) // CHARS_PER_TOKEN
+        if window and window_tokens and window_size + size > window_tokens:
+            windows.append(window)
+            window, window_size = [], 0
+        window.append(page_text.number)
+        window_size += size
+    if window or not windows:
+        windows.append(window)
+    return windows
+
+
+def _window_prompt(prompt: str, doc_text: DocumentText, window: list[int]) -> str:
+    text = "\n\n".join(
+        f"=== PAGE {i + 1} ===\n{doc_text[i].text}" for i in window
+    )
+    if len(window) == len(doc_text):
+        text_info = f"{len(doc_text)} pages"
+    else:
+        text_info = f"pages {window[0] + 1} to {window[-1] + 1} of {len(doc_text)}"
+    return build_prompt(prompt, text, text_info)
+
+
+def _redactions(full_prompt: str, model: str, verbose: bool = False) -> Generator:
+    """Streams the completion for the prompt and yields (page number, text, IFG rule) for each REDACT line."""
+    chunks = completion(
+        model=model,
+        messages=[{"role": "user", "content": full_prompt}],
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_base=os.getenv("AZURE_OPENAI_API_BASE"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+        temperature=0,
+        stream=True,
+    )
+    yield from parse_completion(chunks, ifg_rules, verbose)
+
+
+def process_pdf_streaming(
+    doc: Document,
+    prompt: str,
+    verbose: bool = False,
+    model: str = LLM_MODEL,
+    window_tokens: int = LLM_WINDOW_TOKENS,
+    parallelism: int = LLM_PARALLELISM,
+) -> Generator:
+    """
+    Generator producing SSE events for redaction suggestions by an LLM.
+
+    If the document exceeds `window_tokens`, it is split into windows of consecutive pages,
+    which are analyzed concurrently (at most `parallelism` at a time). The highlights are emitted
+    in page order, those of a window as soon as it and all windows before it are finished.
+    A failed window is retried; if it fails again, the analysis fails instead of completing
+    without the highlights of its pages (which would also be cached).
+    """
+    doc_text = extract(doc)
+    windows = page_windows(doc_text, window_tokens)
+    highlights = HighlightDeduplicator()
+
+    def highlight_events(redactions, window: list[int]) -> Generator:
+        for page_number, redact_text, ifg_rule in redactions:
+            if page_number - 1 not in window:
+                print(f"Warning: Ignoring redaction for page {page_number} outside of pages {window}")
+                continue
+            try:
+                page = doc[page_number - 1]
+                with stage("highlights"):
+                    highlight = highlights.lookup(
+                        page_number,
+                        redact_text,
+                        lambda: find_highlight(page, doc_text[page_number - 1], redact_text, ifg_rule),
+                    )
+                if highlights.is_new(highlight):
+                    with stage("serialization"):
+                        event = f"data: {json.dumps(highlight)}\n\n"
+                    yield event
+
+            except Exception as e:
+                print(f"Error processing redaction: {e}")
+
+    def analyze_window(window: list[int]) -> list[tuple]:
+        pages = f"pages {window[0] + 1} to {window[-1] + 1}"
+        for attempt in range(LLM_RETRIES + 1):
+            try:
+                redactions = list(_redactions(_window_prompt(prompt, doc_text, window), model, verbose))
+                return sorted(redactions, key=lambda redaction: redaction[0])
+            except Exception as e:
+                if attempt == LLM_RETRIES:
+                    raise RuntimeError(f"Analysis of {pages} failed: {e}") from e
+                print(f"Warning: Analysis of {pages} failed, retrying: {e}")
+                time.sleep(LLM_RETRY_DELAY * 2**attempt)
+
     def generate():
         yield 'data: {"status": "started"}\n\n'
 
-        buffer = []
-        current_page = None
-
-        for chunk in completion(
-            model=model,
-            messages=[{"role": "user", "content": full_prompt}],
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_base=os.getenv("AZURE_OPENAI_API_BASE"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            temperature=0,
-            stream=True,
-        ):
-            if chunk.choices[0].finish_reason is not None:
-                buffer.append("\n")
-            else:
-                buffer.append(chunk.choices[0].delta.content)
-            text = "".join(buffer)
-
-            if "\n" in text:
-                lines = text.split("\n")
-                buffer = [lines[-1]]
-
-                for line in lines[:-1]:
-                    line = line.strip()
-                    if verbose:
-                        print(line)
-                    if not line:
-                        continue
-
-                    elif line.startswith("PAGE:"):
-                        current_page = int(line[5:].strip())
-                    elif line.startswith('REDACT: "'):
-                        redact_text, reason = line[8:].strip().split("|")
-                        redact_text = redact_text.strip().strip('"')
-                        reason = reason.strip()
-                        ifg_rule = next(
-                            (rule for rule in ifg_rules if rule["title"] == reason),
-                            None,
-                        )
-                        if current_page and redact_text:
-                            try:
-                                page = doc[current_page - 1]
-                                highlight = get_highlight(page, redact_text, ifg_rule)
-                                if highlight:
-                                    yield f"data: {json.dumps(highlight)}\n\n"
-
-                            except Exception as e:
-                                print(f"Error processing redaction: {e}")
+        if len(windows) == 1:
+            # stream the highlights while the completion is running
+            full_prompt = _window_prompt(prompt, doc_text, windows[0])
+            yield from highlight_events(_redactions(full_prompt, model, verbose), windows[0])
+        else:
+            # The completions run in threads, but the highlights are looked up in this thread,
+            # because PyMuPDF documents must not be used from several threads at once.
+            executor = ThreadPoolExecutor(max_workers=parallelism)
+            try:
+                futures = [executor.submit(analyze_window, window) for window in windows]
+                # the windows finish in any order; finished ones wait here until those before them are done
+                for window, future in zip(windows, futures):
+                    yield from highlight_events(future.result(), window)
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
 
         yield 'data: {"status": "completed"}\n\n'
 
     return generate
 
 
-def process_pdf(doc: Document, prompt: str, model: str = "azure/gpt-4o-mini") -> list[dict]:
-    highlights = []
-    for highlight in process_pdf_streaming(doc, prompt, verbose=False, model=model)():
-        if not highlight.startswith('data: {"status":'):
-            highlights.append(json.loads(highlight.split("data: ")[1]))
-    # remove duplicates but keep order
-    unique_highlights = []
-    for item in highlights:
-        if item not in unique_highlights:
-            unique_highlights.append(item)
-    return unique_highlights
+def process_pdf(doc: Document, prompt: str, model: str = LLM_MODEL) -> list[dict]:
+    # remove duplicates (by ID) but keep order
+    highlights = {}
+    for event in process_pdf_streaming(doc, prompt, verbose=False, model=model)():
+        if not event.startswith('data: {"status":'):
+            highlight = json.loads(event.split("data: ")[1])
+            highlights.setdefault(highlight["id"], highlight)
+    return list(highlights.values())
@@ -1,13 +1,19 @@
 import json
+import os
+import re
 from typing import Generator
 
 import flair
 import torch
 from flair.data import Sentence
 from flair.models import SequenceTagger
-from langdetect import detect
-from processing_ai import get_highlight, ifg_rules
-from pymupdf import Document
+from extraction import PageText, extract
+from highlights import HighlightDeduplicator, get_highlight, get_highlight_at
+from language import detection_settings, page_languages
+from metrics import stage
+from pymupdf import Document, Page
+from quantization import FAST_CPU, load_quantized
+from rules import ifg_rules
 
 if torch.backends.mps.is_available():
     flair.device = torch.device("mps")
@@ -25,41 +31,160 @@ _taggers: dict[str, SequenceTagger] = {}
 
 rule_pii = next(r for r in ifg_rules if r["title"] == "Personenbezogene Daten")
 
+# Number of chunks that are tagged together (across page boundaries).
+BATCH_SIZE = int(os.getenv("FLAIR_BATCH_SIZE", "32"))
+# Upper bound for the length of a single chunk; the transformer cost grows with the sequence length.
+MAX_CHUNK_CHARS = int(os.getenv("FLAIR_MAX_CHUNK_CHARS", "512"))
+
+_sentence_boundary = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
 
 def _load_tagger(lang: str) -> SequenceTagger:
     """Load (and cache) a Flair NER tagger for the given language."""
     if lang not in _taggers:
         model_name = _models.get(lang, _models["en"])
-        _taggers[lang] = SequenceTagger.load(model_name)
+        if FAST_CPU and flair.device.type == "cpu":
+            _taggers[lang] = load_quantized(model_name, lambda: SequenceTagger.load(model_name))
+        else:
+            _taggers[lang] = SequenceTagger.load(model_name)
     return _taggers[lang]
 
 
-def process_pdf_streaming(doc: Document, prompt: str) -> Generator:
-    """Generator producing SSE events for NER redaction suggestions using Flair."""
+def cache_tag() -> str:
+    """Fingerprint of the settings that change the results (part of the cache key)."""
+    return json.dumps(
+        {
+            "models": _models,
+            "fast_cpu": FAST_CPU and flair.device.type == "cpu",
+            "max_chunk_chars": MAX_CHUNK_CHARS,
+            "language": detection_settings(),
+        },
+        sort_keys=True,
+    )
+
+
+def preload(langs: list[str]) -> None:
+    """Loads the taggers for the given languages ahead of the first request."""
+    for lang in langs:
+        _load_tagger(lang if lang in _models else "en")
+
+
+def _windows(text: str, start: int, end: int, max_chars: int) -> Generator:
+    """Split text[start:end] into windows of at most max_chars, preferably at whitespace."""
+    while end - start > max_chars:
+        cut = text.rfind(" ", start + 1, start + max_chars)
+        if cut == -1:
+            cut = text.rfind("\n", start + 1, start + max_chars)
+        if cut == -1:
+            cut = start + max_chars
+        yield start, cut
+        start = cut
+    yield start, end
+
+
+def _chunk_text(text: str, max_chars: int = MAX_CHUNK_CHARS) -> list[tuple[int, str]]:
+    """
+    Splits page text into sentence-like chunks of at most max_chars characters.
+    Returns (offset, chunk) pairs, where offset is the position of the chunk in the page text.
+    Line breaks are replaced by spaces (which keeps the offsets intact), so that the
+    whitespace tokenizer of Flair also splits tokens at line breaks.
+    """
+    spans = []
+    chunk_start = sentence_start = 0
+    for match in _sentence_boundary.finditer(text):
+        if match.end() - chunk_start > max_chars and sentence_start > chunk_start:
+            spans.append((chunk_start, sentence_start))
+            chunk_start = sentence_start
+        sentence_start = match.end()
+    if len(text) - chunk_start > max_chars and sentence_start > chunk_start:
+        spans.append((chunk_start, sentence_start))
+        chunk_start = sentence_start
+    spans.append((chunk_start, len(text)))
 
-    lang = detect(" ".join(page.get_text() for page in doc))
-    if lang not in _models:
-        lang = "en"  # default fallback
-    tagger = _load_tagger(lang)
+    chunks = []
+    for start, end in spans:
+        for window_start, window_end in _windows(text, start, end, max_chars):
+            chunk = text[window_start:window_end]
+            stripped = chunk.lstrip()
+            if not stripped.strip():
+                continue
+            offset = window_start + len(chunk) - len(stripped)
+            chunks.append((offset, stripped.rstrip().replace("\n", " ")))
+    return chunks
+
+
+def _page_events(
+    page: Page,
+    page_text: PageText,
+    chunks: list[tuple[int, Sentence]],
+    highlights: HighlightDeduplicator,
+) -> Generator:
+    """Yields the SSE events for the tagged chunks of a single page."""
+    text = page_text.text
+    for offset, sentence in chunks:
+        for span in sentence.get_spans("ner"):
+            if span.tag in ["PER"]:
+                start = offset + span.start_position
+                end = offset + span.end_position
+                with stage("highlights"):
+                    if text[start:end].split() == span.text.split():
+                        highlight = get_highlight_at(page, page_text, start, end, rule_pii)
+                    else:
+                        # Flair normalizes some characters, which can shift the offsets
+                        context = text[max(0, start - 10) : min(len(text), end + 10)]
+                        highlight = get_highlight(page, span.text, rule_pii, context=context)
+                if highlights.is_new(highlight):
+                    with stage("serialization"):
+                        event = f"data: {json.dumps(highlight)}\n\n"
+                    yield event
+
+
+def process_pdf_streaming(
+    doc: Document, prompt: str, batch_size: int = BATCH_SIZE
+) -> Generator:
+    """
+    Generator producing SSE events for NER redaction suggestions using Flair.
+
+    The page texts are split into sentence chunks, which are tagged in mini-batches across
+    page boundaries (one batch per language, see `language.page_languages`). The highlights
+    of a page are streamed as soon as all its chunks and those of the pages before are tagged.
+    """
+
+    doc_text = extract(doc)
+    languages = page_languages(doc_text, _models, "en")
+    preload(sorted(set(languages)))
 
     def generate():
         yield 'data: {"status": "started"}\n\n'
-        for page in doc:
-            text = page.get_text()
-            sentence = Sentence(text, use_tokenizer=False)
-            tagger.predict(sentence)
-            for span in sentence.get_spans("ner"):
-                if span.tag in ["PER"]:
-                    context = text[
-                        max(0, span.start_position - 10) : min(
-                            len(text), span.end_position + 10
-                        )
-                    ]
-                    highlight = get_highlight(
-                        page, span.text, rule_pii, context=context
-                    )
-                    if highlight:
-                        yield f"data: {json.dumps(highlight)}\n\n"
+        highlights = HighlightDeduplicator()
+        pending = []  # [page, page text, chunks, language, tagged] in page order
+        batches: dict[str, list[Sentence]] = {}  # chunks waiting to be tagged, per language
+
+        def tag(lang: str):
+            sentences = batches.pop(lang)
+            if sentences:
+                with stage("inference"):
+                    _load_tagger(lang).predict(sentences, mini_batch_size=batch_size)
+            for entry in pending:
+                if entry[3] == lang:
+                    entry[4] = True
+
+        for page_text, lang in zip(doc_text, languages):
+            chunks = [
+                (offset, Sentence(chunk, use_tokenizer=False))
+                for offset, chunk in _chunk_text(page_text.text)
+            ]
+            pending.append([doc[page_text.number], page_text, chunks, lang, not chunks])
+            batch = batches.setdefault(lang, [])
+            batch.extend(sentence for _, sentence in chunks)
+            if len(batch) >= batch_size:
+                tag(lang)
+            while pending and pending[0][4]:
+                yield from _page_events(*pending.pop(0)[:3], highlights)
+        for lang in list(batches):
+            tag(lang)
+        for entry in pending:
+            yield from _page_events(*entry[:3], highlights)
         yield 'data: {"status": "completed"}\n\n'
 
     return generate
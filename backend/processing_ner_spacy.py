@@ -2,9 +2,12 @@ import json
 from typing import Generator
 
 import spacy
-from processing_ai import get_highlight, ifg_rules
+from extraction import extract
+from highlights import HighlightDeduplicator, get_highlight_at
+from metrics import stage
 from pymupdf import Document
-from langdetect import detect
+from language import detection_settings, page_languages
+from rules import ifg_rules
 
 tags = {
     "de": ["PER"],
@@ -12,11 +15,13 @@ tags = {
 }
 rule_pii = [a for a in ifg_rules if a["title"] == "Personenbezogene Daten"][0]
 
+model_names = {
+    "de": "de_core_news_lg",
+    "en": "en_core_web_lg",
+}
+
 def load_model(lang: str) -> spacy.Language:
-    model = {
-        "de": "de_core_news_lg",
-        "en": "en_core_web_lg",
-    }[lang]
+    model = model_names[lang]
     try:
         return spacy.load(model)
     except Exception:
@@ -25,25 +30,40 @@ def load_model(lang: str) -> spacy.Language:
 
 models = {}
 
+def cache_tag() -> str:
+    """Fingerprint of the settings that change the results (part of the cache key)."""
+    return json.dumps(
+        {"models": model_names, "spacy": spacy.__version__, "language": detection_settings()},
+        sort_keys=True,
+    )
+
+def preload(langs: list[str]) -> None:
+    """Loads the models for the given languages ahead of the first request."""
+    for lang in langs:
+        if lang not in models:
+            models[lang] = load_model(lang)
+
 def process_pdf_streaming(doc: Document, prompt: str) -> Generator:
-    lang = detect(" ".join(page.get_text() for page in doc))
-    if lang not in models:
-        models[lang] = load_model(lang)
+    doc_text = extract(doc)
+    languages = page_languages(doc_text, tags, "en")
+    preload(sorted(set(languages)))
     def generate():
         yield 'data: {"status": "started"}\n\n'
-        for page in doc:
-            text = page.get_text()
-            for ent in models[lang](text).ents:
+        highlights = HighlightDeduplicator()
+        for page_text, lang in zip(doc_text, languages):
+            page = doc[page_text.number]
+            with stage("inference"):
+                ents = models[lang](page_text.text).ents
+            for ent in ents:
                 if ent.label_ in tags[lang]:
-                    text = text[: ent.start_char] + ent.label_ + text[ent.end_char :]
-                    context = page.get_text()[
-                        max(0, ent.start_char - 10) : min(
-                            len(page.get_text()), ent.end_char + 10
+                    with stage("highlights"):
+                        highlight = get_highlight_at(
+                            page, page_text, ent.start_char, ent.end_char, rule_pii
                         )
-                    ]
-                    highlight = get_highlight(page, ent.text, rule_pii, context=context)
-                    if highlight:
-                        yield f"data: {json.dumps(highlight)}\n\n"
+                    if highlights.is_new(highlight):
+                        with stage("serialization"):
+                            event = f"data: {json.dumps(highlight)}\n\n"
+                        yield event
         yield 'data: {"status": "completed"}\n\n'
 
     return generate
@@ -2,9 +2,13 @@ import json
 from typing import Generator
 
 import stanza
-from processing_ai import get_highlight, ifg_rules
+from extraction import extract
+from highlights import HighlightDeduplicator, get_highlight_at
+from metrics import stage
 from pymupdf import Document
-from langdetect import detect
+from quantization import FAST_CPU, quantize_stanza_pipeline
+from language import detection_settings, page_languages
+from rules import ifg_rules
 
 rule_pii = [r for r in ifg_rules if r["title"] == "Personenbezogene Daten"][0]
 
@@ -18,21 +22,43 @@ def _load_pipeline(lang: str) -> stanza.Pipeline:
 
 pipelines = {}
 
+def cache_tag() -> str:
+    """Fingerprint of the settings that change the results (part of the cache key)."""
+    return json.dumps(
+        {"stanza": stanza.__version__, "fast_cpu": FAST_CPU, "language": detection_settings()},
+        sort_keys=True,
+    )
+
+def preload(langs: list[str]) -> None:
+    """Loads the pipelines for the given languages ahead of the first request."""
+    for lang in langs:
+        if lang not in pipelines:
+            pipelines[lang] = _load_pipeline(lang)
+            if FAST_CPU:
+                quantize_stanza_pipeline(pipelines[lang])
+
 def process_pdf_streaming(doc: Document, prompt: str) -> Generator:
-    lang = detect(" ".join(page.get_text() for page in doc))
-    if lang not in pipelines:
-        pipelines[lang] = _load_pipeline(lang)
+    doc_text = extract(doc)
+    languages = page_languages(doc_text, None, "en")
+    preload(sorted(set(languages)))
 
     def generate():
         yield 'data: {"status": "started"}\n\n'
-        for page in doc:
-            text = page.get_text()
-            for ent in pipelines[lang](text).ents:
+        highlights = HighlightDeduplicator()
+        for page_text, lang in zip(doc_text, languages):
+            page = doc[page_text.number]
+            with stage("inference"):
+                ents = pipelines[lang](page_text.text).ents
+            for ent in ents:
                 if ent.type in ["PER"]:
-                    context = text[max(0, ent.start_char - 10) : min(len(text), ent.end_char + 10)]
-                    highlight = get_highlight(page, ent.text, rule_pii, context=context)
-                    if highlight:
-                        yield f"data: {json.dumps(highlight)}\n\n"
+                    with stage("highlights"):
+                        highlight = get_highlight_at(
+                            page, page_text, ent.start_char, ent.end_char, rule_pii
+                        )
+                    if highlights.is_new(highlight):
+                        with stage("serialization"):
+                            event = f"data: {json.dumps(highlight)}\n\n"
+                        yield event
         yield 'data: {"status": "completed"}\n\n'
 
     return generate 
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+Pattern-based engine for structured identifiers: e-mail addresses, phone numbers, IBANs, German tax and
+social security numbers, ID card numbers, licence plates and IP addresses.
+
+All patterns are compiled into a single regular expression with one named group per pattern, which is
+run once over the extracted text of each page. The patterns only start matching at the beginning of a
+token (see the lookbehinds), so that the search stays linear in the length of the text. Matches that
+need a checksum or a plausibility check (IBAN, tax ID, ...) are validated before they are emitted.
+
+PATTERNS selects the patterns (comma-separated names, default: all but the opt-in ones, see
+OPT_IN_PATTERNS); PATTERNS_FILE points to a JSON
+object with additional or replacing patterns: {"name": {"pattern": "...", "rule": "<IFG rule title>"}}.
+"""
+
+import json
+import os
+import re
+from typing import Callable, Generator
+
+from extraction import extract
+from highlights import HighlightDeduplicator, get_highlight_at
+from metrics import stage
+from pymupdf import Document
+from rules import ifg_rules
+
+PII = "Personenbezogene Daten"
+
+
+def _iban_valid(text: str) -> bool:
+    iban = text.replace(" ", "")
+    if not 15 <= len(iban) <= 34:
+        return False
+    digits = "".join(str(int(c, 36)) for c in iban[4:] + iban[:4])
+    return int(digits) % 97 == 1
+
+
+def _tax_id_valid(text: str) -> bool:
+    """Check digit of the German tax identification number (ISO 7064, MOD 11,10)."""
+    digits = [int(c) for c in text if c.isdigit()]
+    product = 10
+    for digit in digits[:10]:
+        total = (digit + product) % 10 or 10
+        product = (total * 2) % 11
+    return (11 - product) % 10 == digits[10]
+
+
+def _min_digits(n: int) -> Callable[[str], bool]:
+    return lambda text: sum(c.isdigit() for c in text) >= n
+
+
+def _ip_valid(text: str) -> bool:
+    parts = text.split(".")
+    # leading zeros occur in numbers with thousands separators (e.g. "100.000.000.000"), not in addresses
+    if any(len(part) > 1 and part.startswith("0") for part in parts):
+        return False
+    return all(int(part) <= 255 for part in parts)
+
+
+# Abbreviations of legal and standards references that look like licence plates, e.g. "VO EG 1049" or "DIN EN 1234"
+NOT_LICENCE_PLATES = {"DIN", "ISO", "EN", "VO", "EG", "EU", "EWG", "RL", "GG", "BGB", "IFG", "KW", "NR"}
+
+
+def _licence_plate_valid(text: str) -> bool:
+    district, letters = text.replace("-", " ").split()[:2]
+    return district not in NOT_LICENCE_PLATES and letters.rstrip("0123456789") not in NOT_LICENCE_PLATES
+
+
+# name -> (pattern, IFG rule title, validator or None)
+# Patterns must not contain capturing groups; separators are single spaces, so that matches don't span lines.
+PATTERNS: dict[str, tuple[str, str, Callable[[str], bool] | None]] = {
+    "email": (r"(?<![\w.%+-])[\w.%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}(?![\w-])", PII, None),
+    "phone": (
+        r"(?<![\w+])(?:\+\d{1,3} ?(?:\(0\) ?)?\d{1,5}|0\d{2,5})(?:[ /-]\d{2,10}){0,3}(?![\w])",
+        PII,
+        _min_digits(7),
+    ),
+    "iban": (r"(?<![\w])[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,3})?(?![\w])", PII, _iban_valid),
+    "tax_id": (r"(?<![\w])[1-9]\d(?: ?\d{3}){3}(?![\w])", PII, _tax_id_valid),
+    "tax_number": (r"(?<![\w/])\d{2,3}/\d{3,4}/\d{4,5}(?![\w/])", PII, None),
+    "social_security_number": (r"(?<![\w])\d{2} ?\d{6} ?[A-Z] ?\d{3}(?![\w])", PII, None),
+    "id_card_number": (r"(?<![\w])[CFGHJKLMNPRTVWXYZ][CFGHJKLMNPRTVWXYZ0-9]{8}(?![\w])", PII, _min_digits(3)),
+    "licence_plate": (
+        r"(?<![\w-])[A-ZÄÖÜ]{1,3}[- ][A-Z]{1,2} ?[1-9]\d{0,3}[EH]?(?![\w-])",
+        PII,
+        _licence_plate_valid,
+    ),
+    "ip_address": (r"(?<![\w.])(?:\d{1,3}\.){3}\d{1,3}(?![\w.])", PII, _ip_valid),
+}
+
+if os.getenv("PATTERNS_FILE"):
+    with open(os.getenv("PATTERNS_FILE"), "r", encoding="utf-8") as f:
+        for name, spec in json.load(f).items():
+            PATTERNS[name] = (spec["pattern"], spec.get("rule", PII), None)
+
+# Patterns with many false positives in IFG documents, which are only used if selected with PATTERNS
+OPT_IN_PATTERNS = {"licence_plate"}
+ENABLED_PATTERNS = [
+    name.strip()
+    for name in os.getenv("PATTERNS", ",".join(p for p in PATTERNS if p not in OPT_IN_PATTERNS)).split(",")
+    if name.strip()
+]
+
+rules_by_title = {rule["title"]: rule for rule in ifg_rules}
+
+
+def compile_patterns(names: list[str]) -> re.Pattern:
+    """Combines the patterns into a single regular expression with a named group per pattern."""
+    return re.compile("|".join(f"(?P<{name}>{PATTERNS[name][0]})" for name in names))
+
+
+matcher = compile_patterns(ENABLED_PATTERNS)
+
+
+def cache_tag() -> str:
+    """Fingerprint of the enabled patterns (part of the cache key)."""
+    return json.dumps({name: PATTERNS[name][:2] for name in ENABLED_PATTERNS}, sort_keys=True)
+
+
+def preload(langs: list[str]) -> None:
+    """Nothing to load ahead of time, the patterns are compiled on import."""
+
+
+def find_matches(text: str, patterns: re.Pattern | None = None) -> Generator:
+    """Yields (start, end, pattern name) for the valid matches in a text (of the enabled patterns by default)."""
+    for match in (patterns or matcher).finditer(text):
+        name = match.lastgroup
+        validate = PATTERNS[name][2]
+        if validate is None or validate(match.group()):
+            yield match.start(), match.end(), name
+
+
+def process_pdf_streaming(doc: Document, prompt: str) -> Generator:
+    """Generator producing SSE events for the structured identifiers in a document (the prompt is not used)."""
+    doc_text = extract(doc)
+
+    def generate():
+        yield 'data: {"status": "started"}\n\n'
+        highlights = HighlightDeduplicator()
+        for page_text in doc_text:
+            page = doc[page_text.number]
+            with stage("matching"):
+                matches = list(find_matches(page_text.text))
+            for start, end, name in matches:
+                with stage("highlights"):
+                    rule = rules_by_title.get(PATTERNS[name][1])
+                    highlight = get_highlight_at(page, page_text, start, end, rule)
+                if highlights.is_new(highlight):
+                    with stage("serialization"):
+                        event = f"data: {json.dumps(highlight)}\n\n"
+                    yield event
+        yield 'data: {"status": "completed"}\n\n'
+
+    return generate
@@ -0,0 +1,137 @@
+"""
+Opt-in "fast CPU" mode for the NER taggers.
+
+With FAST_CPU=1, the torch models of the Flair taggers (and the Stanza NER models) are quantized
+dynamically to INT8 after loading, which speeds up CPU inference at a small cost in accuracy.
+Quantized Flair taggers are cached on disk, so that the quantization only runs once per model.
+
+Run `uv run python quantization.py <document.pdf> [--lang de]` to compare the throughput and
+the agreement of the quantized and the full-precision Flair tagger on a document.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    import torch
+
+FAST_CPU = os.getenv("FAST_CPU", "").lower() in ("1", "true", "yes")
+# Intra-op threads per process; 0 divides the cores evenly between the worker processes.
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))
+QUANTIZED_CACHE_DIR = os.getenv(
+    "QUANTIZED_CACHE_DIR", os.path.expanduser("~/.cache/auto-redact/quantized")
+)
+
+
+def configure_threads(workers: int = 1) -> int:
+    """
+    Sets the number of torch intra-op threads for a process that shares the CPU with `workers - 1`
+    other processes, so that the processes don't oversubscribe the cores. Call it after importing
+    the engine: engines that don't use torch (and thus haven't imported it) are left alone.
+    """
+    threads = TORCH_THREADS or max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+    return threads
+
+
+def quantize(model: "torch.nn.Module") -> "torch.nn.Module":
+    """Quantizes the linear and LSTM layers of a model to INT8 (weights only, activations at runtime)."""
+    import torch
+
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8
+    )
+
+
+def load_quantized(model_name: str, load: Callable[[], "torch.nn.Module"]) -> "torch.nn.Module":
+    """Loads the quantized version of a model from the disk cache, or quantizes and caches it."""
+    import torch
+
+    key = hashlib.sha256(f"{model_name}@{torch.__version__}".encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(QUANTIZED_CACHE_DIR, f"{model_name.replace('/', '_')}-{key}.pt")
+    if os.path.exists(path):
+        try:
+            return torch.load(path, weights_only=False)
+        except Exception as e:
+            print(f"Warning: Could not load quantized model from {path}: {e}")
+    model = quantize(load())
+    os.makedirs(QUANTIZED_CACHE_DIR, exist_ok=True)
+    torch.save(model, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    return model
+
+
+def quantize_stanza_pipeline(pipeline) -> None:
+    """Quantizes the NER models of a Stanza pipeline in place."""
+    import torch
+
+    processor = pipeline.processors.get("ner")
+    if processor is None:
+        return
+    # newer Stanza versions support several NER models per processor
+    trainers = getattr(processor, "trainers", None) or [getattr(processor, "_trainer", None)]
+    for trainer in trainers:
+        if trainer is not None and isinstance(getattr(trainer, "model", None), torch.nn.Module):
+            trainer.model = quantize(trainer.model)
+
+
+def compare(pdf_path: str, lang: str = "de", batch_size: int = 32):
+    """Prints throughput and agreement of the full-precision and the quantized Flair tagger."""
+    import flair
+    import pymupdf
+    import torch
+    from flair.data import Sentence
+    from flair.models import SequenceTagger
+
+    from extraction import extract
+    from processing_ner_flair import _chunk_text, _models
+
+    flair.device = torch.device("cpu")
+    configure_threads()
+    doc = pymupdf.open(pdf_path)
+    chunks = [chunk for page_text in extract(doc) for _, chunk in _chunk_text(page_text.text)]
+    model_name = _models[lang]
+    taggers = {
+        "full precision": lambda: SequenceTagger.load(model_name),
+        "int8": lambda: load_quantized(model_name, lambda: SequenceTagger.load(model_name)),
+    }
+
+    spans = {}
+    for name, load in taggers.items():
+        tagger = load()
+        sentences = [Sentence(chunk, use_tokenizer=False) for chunk in chunks]
+        start = time.perf_counter()
+        tagger.predict(sentences, mini_batch_size=batch_size)
+        duration = time.perf_counter() - start
+        spans[name] = {
+            (i, span.start_position, span.end_position, span.tag)
+            for i, sentence in enumerate(sentences)
+            for span in sentence.get_spans("ner")
+        }
+        print(
+            f"{name:>15}: {doc.page_count / duration:6.2f} pages/s, "
+            f"{len(spans[name])} entities in {duration:.1f}s"
+        )
+
+    reference, quantized = spans["full precision"], spans["int8"]
+    tp = len(reference & quantized)
+    precision = tp / len(quantized) if quantized else 0
+    recall = tp / len(reference) if reference else 0
+    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) else 0
+    print(f"Agreement of int8 with full precision: P={precision:.3f} R={recall:.3f} F1={f1:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare quantized and full-precision Flair NER")
+    parser.add_argument("pdf")
+    parser.add_argument("--lang", default="de")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+    compare(args.pdf, args.lang, args.batch_size)
@@ -0,0 +1,72 @@
+"""
+Incremental parser for the PAGE/REDACT commands in the streamed output of the LLM.
+
+Chunks are only joined once a line is complete, so the total work is linear in the length of
+the response, and IFG rules are looked up by title in a dict.
+"""
+
+import re
+from typing import Iterable, Generator
+
+_page_number = re.compile(r"\d+")
+
+# (1-based page number, text to redact, IFG rule or None)
+Redaction = tuple[int, str, dict | None]
+
+
+class RedactStreamParser:
+    def __init__(self, rules: list[dict], verbose: bool = False):
+        self.rules_by_title = {rule["title"]: rule for rule in rules}
+        self.verbose = verbose
+        self.current_page: int | None = None
+        self._partial_line: list[str] = []
+
+    def feed(self, chunk: str) -> list[Redaction]:
+        """Consumes a chunk of the response and returns the redactions of the lines it completes."""
+        if "\n" not in chunk:
+            self._partial_line.append(chunk)
+            return []
+        lines = chunk.split("\n")
+        self._partial_line.append(lines[0])
+        lines[0] = "".join(self._partial_line)
+        self._partial_line = [lines[-1]]
+        redactions = []
+        for line in lines[:-1]:
+            if redaction := self.parse_line(line):
+                redactions.append(redaction)
+        return redactions
+
+    def close(self) -> list[Redaction]:
+        """Parses the last line, if the response does not end with a line break."""
+        line = "".join(self._partial_line)
+        self._partial_line = []
+        redaction = self.parse_line(line)
+        return [redaction] if redaction else []
+
+    def parse_line(self, line: str) -> Redaction | None:
+        line = line.strip()
+        if self.verbose:
+            print(line)
+        if line.startswith("PAGE:"):
+            if match := _page_number.search(line, 5):
+                self.current_page = int(match.group())
+            else:
+                print(f"Warning: Could not parse page number from '{line}'")
+        elif line.startswith('REDACT: "'):
+            redact_text, _, reason = line[8:].rpartition("|")
+            if not redact_text:  # no reason given
+                redact_text, reason = reason, ""
+            redact_text = redact_text.strip().strip('"')
+            ifg_rule = self.rules_by_title.get(reason.strip())
+            if self.current_page and redact_text:
+                return self.current_page, redact_text, ifg_rule
+        return None
+
+
+def parse_completion(chunks: Iterable, rules: list[dict], verbose: bool = False) -> Generator:
+    """Yields the redactions from the chunks of a streamed `litellm.completion`."""
+    parser = RedactStreamParser(rules, verbose)
+    for chunk in chunks:
+        if content := chunk.choices[0].delta.content:
+            yield from parser.feed(content)
+    yield from parser.close()
@@ -0,0 +1,11 @@
+"""
+The rules of the Informationsfreiheitsgesetz (IFG) to which redactions refer.
+"""
+
+import json
+
+with open("../rules/informationsfreiheitsgesetz.json", "r", encoding="utf-8") as f:
+    ifg_rules = json.load(f)["rules"]
+ifg_text = "\n\n".join(
+    [f"{rule['reference']}: {rule['title']}\n{rule['full_text']}" for rule in ifg_rules]
+)
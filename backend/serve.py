@@ -0,0 +1,73 @@
+"""
+Serves the app with several worker processes that share the preloaded models.
+
+Unlike `uvicorn --workers`, which starts every worker from scratch, the models for
+PRELOAD_LANGUAGES are loaded once in this process, which then forks the workers. The model
+weights are thus shared copy-on-write between the workers instead of being held by each of them.
+Only suitable for CPU inference: CUDA and MPS do not survive a fork. The worker pool (NER_WORKERS)
+is not supported, as its processes and dispatcher thread cannot be shared by forked workers; use
+either this launcher or the pool.
+
+Usage: PRELOAD_LANGUAGES=de,en uv run python serve.py --workers 4 --port 8000
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+
+import uvicorn
+from quantization import configure_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    import main as app_module
+
+    if app_module.worker_pool.NER_WORKERS:
+        parser.error("NER_WORKERS is not supported, unset it or use a single uvicorn process")
+    app_module.preload_models()
+    # Move everything allocated so far out of the reach of the garbage collector,
+    # which would otherwise touch (and thus copy) the shared pages in every worker.
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            configure_threads(args.workers)
+            config = uvicorn.Config(app_module.app, log_level="info")
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        children.append(pid)
+    print(f"Serving on {args.host}:{args.port} with {len(children)} workers")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Server-side document sessions, so that a PDF is uploaded only once per editing session.
+
+/api/upload-pdf stores the cleaned PDF (without redaction annotations) under a random ID,
+which /api/analyze-pdf and /api/download-pdf accept instead of the file. Sessions expire after
+SESSION_TTL seconds without access; if the PDFs held in memory exceed SESSION_MEMORY_LIMIT,
+the least recently used sessions are dropped. Clients fall back to sending the file again.
+"""
+
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from uploads import PdfSource, remove_file
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_MEMORY_LIMIT = int(os.getenv("SESSION_MEMORY_LIMIT", str(512 * 2**20)))
+
+
+class Session(PdfSource):
+    def __init__(self, id: str, filename: str, data: bytes | None = None, path: str | None = None):
+        super().__init__(data=data, path=path)
+        self.id = id
+        self.filename = filename
+        self.last_access = time.monotonic()
+
+    def discard(self):
+        """Removes the file of the session (if any) once the session has been dropped."""
+        if self.path:
+            remove_file(self.path)
+
+
+class SessionStore:
+    def __init__(self, ttl: int = SESSION_TTL, memory_limit: int = SESSION_MEMORY_LIMIT):
+        self.ttl = ttl
+        self.memory_limit = memory_limit
+        self._sessions: OrderedDict[str, Session] = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+
+    def create(self, pdf: bytes | str, filename: str) -> Session:
+        """Creates a session for the bytes or the path of a PDF; the session takes over the file."""
+        data, path = (None, pdf) if isinstance(pdf, str) else (pdf, None)
+        session = Session(secrets.token_urlsafe(16), filename, data=data, path=path)
+        with self._lock:
+            self._sessions[session.id] = session
+        self._evict()
+        return session
+
+    def get(self, session_id: str) -> Session | None:
+        self._evict()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(session_id)
+        return session
+
+    def _evict(self):
+        dropped = []
+        with self._lock:
+            now = time.monotonic()
+            for session_id, session in list(self._sessions.items()):
+                if now - session.last_access <= self.ttl:
+                    break  # the remaining sessions have been used more recently
+                dropped.append(self._sessions.pop(session_id))
+            memory = sum(s.size for s in self._sessions.values() if s.in_memory)
+            for session_id, session in list(self._sessions.items()):
+                if memory <= self.memory_limit:
+                    break
+                if session.in_memory:
+                    dropped.append(self._sessions.pop(session_id))
+                    memory -= session.size
+        for session in dropped:
+            session.discard()
+
+
+sessions = SessionStore()
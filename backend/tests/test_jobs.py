@@ -0,0 +1,63 @@
+import io
+import threading
+import time
+
+import jobs
+import pymupdf
+import pytest
+from fastapi import UploadFile
+from jobs import JobQueue
+
+
+def _upload(name: str) -> UploadFile:
+    doc = pymupdf.open()
+    doc.new_page().insert_text((50, 72), "Kontakt: max.mueller@bund.example.de")
+    return UploadFile(io.BytesIO(doc.tobytes()), filename=name)
+
+
+def _wait(condition, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture(autouse=True)
+def short_lease(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_LEASE", 0.4)
+    monkeypatch.setattr(jobs, "POLL_INTERVAL", 0.05)
+
+
+def test_running_documents_are_not_taken_over(tmp_path):
+    release = threading.Event()
+    calls = []
+
+    def analyze(source, prompt, engine):
+        calls.append(source.path)
+        release.wait(30)
+        return []
+
+    first = JobQueue(analyze, str(tmp_path), workers=1)
+    job_id = first.submit([_upload("a.pdf")], "", "patterns")
+    first.start()
+    _wait(lambda: first.status(job_id)["running"] == 1)
+    # e.g. another server process that starts while the document is being processed
+    second = JobQueue(analyze, str(tmp_path), workers=1)
+    second.start()
+    time.sleep(1.5)  # several leases, which the first queue renews
+    assert len(calls) == 1
+    release.set()
+    _wait(lambda: first.status(job_id)["status"] == "completed")
+    assert first.status(job_id)["done"] == 1
+    assert len(calls) == 1
+
+
+def test_documents_of_a_stopped_process_are_queued_again(tmp_path):
+    stopped = JobQueue(lambda source, prompt, engine: [], str(tmp_path), workers=1)
+    job_id = stopped.submit([_upload("a.pdf")], "", "patterns")
+    # claimed by a process that stopped before finishing the document
+    assert stopped._claim() is not None
+    queue = JobQueue(lambda source, prompt, engine: [], str(tmp_path), workers=1)
+    queue.start()
+    _wait(lambda: queue.status(job_id)["status"] == "completed")
+    assert queue.status(job_id)["done"] == 1
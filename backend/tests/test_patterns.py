@@ -0,0 +1,75 @@
+import pytest
+from processing_patterns import (
+    PATTERNS,
+    _iban_valid,
+    _ip_valid,
+    _licence_plate_valid,
+    _tax_id_valid,
+    compile_patterns,
+    find_matches,
+)
+
+
+def _matches(text: str, names: list[str]) -> list[tuple[str, str]]:
+    """The (pattern, text) of the matches of the given patterns (also opt-in ones) in a text."""
+    return [(name, text[start:end]) for start, end, name in find_matches(text, compile_patterns(names))]
+
+
+@pytest.mark.parametrize(
+    "iban, valid",
+    [
+        ("DE89 3704 0044 0532 0130 00", True),
+        ("DE89370400440532013000", True),
+        ("DE88 3704 0044 0532 0130 00", False),  # wrong check digits
+        ("DE89 3704", False),  # too short
+    ],
+)
+def test_iban(iban, valid):
+    assert _iban_valid(iban) is valid
+
+
+@pytest.mark.parametrize(
+    "tax_id, valid",
+    [("86095742719", True), ("86 095 742 719", True), ("86095742718", False)],
+)
+def test_tax_id(tax_id, valid):
+    assert _tax_id_valid(tax_id) is valid
+
+
+@pytest.mark.parametrize(
+    "ip, valid",
+    [
+        ("192.168.0.1", True),
+        ("192.168.178.100", True),
+        ("10.100.200.150", True),
+        ("256.1.1.1", False),
+        ("100.000.000.000", False),  # an amount with thousands separators
+        ("1.050.300.100", False),
+    ],
+)
+def test_ip_address(ip, valid):
+    assert _ip_valid(ip) is valid
+    assert bool(_matches(f"Zugriff von {ip} am Montag", ["ip_address"])) is valid
+
+
+@pytest.mark.parametrize(
+    "plate, valid",
+    [
+        ("M XY 99E", True),
+        ("HH-AB 123", True),
+        ("VO EG 1049", False),
+        ("DIN EN 1234", False),
+        ("B KW 12", False),
+    ],
+)
+def test_licence_plate(plate, valid):
+    assert _licence_plate_valid(plate) is valid
+    assert bool(_matches(f"Fahrzeug {plate} wurde", ["licence_plate"])) is valid
+
+
+def test_iban_and_tax_id_in_text():
+    text = "Steuer-ID 86 095 742 719, IBAN DE89 3704 0044 0532 0130 00."
+    assert _matches(text, list(PATTERNS)) == [
+        ("tax_id", "86 095 742 719"),
+        ("iban", "DE89 3704 0044 0532 0130 00"),
+    ]
@@ -0,0 +1,27 @@
+import pymupdf
+from annotations import apply_annotations, apply_annotations_sharded
+
+from benchmarks.redaction import same_redaction_content
+from benchmarks.synthetic import highlight_names, synthetic_pdf
+
+
+def _document() -> tuple[bytes, list[str], list[dict]]:
+    doc, names = synthetic_pdf(pages=5, names_per_page=5)
+    doc.set_toc([[1, "Antrag", 1], [2, "Bescheid", 3], [1, "Anlagen", 5]])
+    return doc.tobytes(), names, highlight_names(doc, names)
+
+
+def test_sharded_redaction_matches_single_process():
+    pdf, names, highlights = _document()
+    single = pymupdf.open(stream=pdf, filetype="pdf")
+    apply_annotations(single, highlights, "final")
+    sharded = apply_annotations_sharded(pdf, highlights, 2)
+    assert same_redaction_content(single, sharded)
+    # the names are gone from every page of the sharded output
+    assert not any(name in page.get_text() for page in sharded for name in names)
+
+
+def test_sharded_redaction_keeps_the_outline():
+    pdf, _, highlights = _document()
+    sharded = apply_annotations_sharded(pdf, highlights, 2)
+    assert sharded.get_toc() == pymupdf.open(stream=pdf, filetype="pdf").get_toc()
@@ -0,0 +1,63 @@
+import os
+import signal
+import threading
+import time
+
+import pymupdf
+import pytest
+from worker_pool import WorkerPool
+
+
+def _pdf() -> bytes:
+    doc = pymupdf.open()
+    doc.new_page().insert_text((50, 72), "Kontakt: max.mueller@bund.example.de")
+    return doc.tobytes()
+
+
+def _wait(condition, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def _events(pool: WorkerPool, timeout: float = 30) -> list[str]:
+    """Collects the events of an analysis in a thread, so that a hanging pool fails the test."""
+    result = {}
+
+    def run():
+        try:
+            result["events"] = list(pool.submit(_pdf(), "")())
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the analysis did not finish"
+    if "error" in result:
+        raise result["error"]
+    return result["events"]
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(engine="patterns", workers=2, queue_size=4, languages=[])
+    _wait(lambda: pool.ready)
+    yield pool
+    pool.close()
+
+
+def test_analysis(pool):
+    events = _events(pool)
+    assert events[-1].startswith('data: {"status": "completed"')
+    assert any("max.mueller@bund.example.de" in event for event in events)
+
+
+def test_killed_idle_worker_is_replaced(pool):
+    for _ in range(2):
+        pid = pool._workers[0].process.pid
+        os.kill(pid, signal.SIGKILL)
+        _wait(lambda: pool.ready and pool._workers[0].process.pid != pid)
+        for _ in range(3):
+            assert _events(pool)[-1].startswith('data: {"status": "completed"')
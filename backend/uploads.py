@@ -0,0 +1,141 @@
+"""
+Uploaded PDFs that are kept in memory only up to a per-request memory ceiling.
+
+Small uploads are read into memory, as before. Larger uploads are copied in chunks from the
+spooled upload into a named temporary file and opened by PyMuPDF from there; documents created
+from them are also written to temporary files and streamed back in chunks.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Iterator
+
+import pymupdf
+from fastapi import UploadFile
+from metrics import stage
+from pymupdf import Document
+
+# Uploads larger than this (in bytes) are kept on disk instead of in memory.
+UPLOAD_MEMORY_LIMIT = int(os.getenv("UPLOAD_MEMORY_LIMIT", str(32 * 2**20)))
+CHUNK_SIZE = 2**20
+
+
+def _size(file: UploadFile) -> int:
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(position)
+    return size
+
+
+def temporary_path(suffix: str = ".pdf") -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="auto-redact-")
+    os.close(fd)
+    return path
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_file(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+class PdfSource:
+    """A PDF, either as bytes in memory or as a file on disk."""
+
+    def __init__(self, data: bytes | None = None, path: str | None = None):
+        self.data = data
+        self.path = path
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self._sha256: str | None = None
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    @property
+    def source(self) -> bytes | str:
+        """The bytes or the path of the PDF, for passing it to another process."""
+        return self.data if self.in_memory else self.path
+
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            if self.in_memory:
+                self._sha256 = hashlib.sha256(self.data).hexdigest()
+            else:
+                digest = hashlib.sha256()
+                for chunk in read_file(self.path):
+                    digest.update(chunk)
+                self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    @stage("open")
+    def open(self) -> Document:
+        return open_pdf(self.source)
+
+    def copy_to_temporary(self) -> str:
+        """Copies the PDF to a temporary file, which the caller has to remove."""
+        path = temporary_path()
+        if self.in_memory:
+            with open(path, "wb") as f:
+                f.write(self.data)
+        else:
+            shutil.copyfile(self.path, path)
+        return path
+
+    @stage("save")
+    def save(self, doc: Document, **options) -> bytes | str:
+        """
+        Serializes a document created from this PDF: to bytes if the PDF is kept in memory,
+        otherwise to a temporary file, whose path is returned and which the caller has to remove.
+        """
+        if self.in_memory:
+            return doc.tobytes(**options)
+        path = temporary_path()
+        doc.save(path, **options)
+        return path
+
+    def close(self):
+        """Releases the resources of the PDF once the response has been sent."""
+
+
+class Upload(PdfSource):
+    """An uploaded PDF, read into memory or, above the memory limit, copied to a temporary file."""
+
+    @stage("upload")
+    def __init__(self, file: UploadFile, memory_limit: int = UPLOAD_MEMORY_LIMIT):
+        if _size(file) <= memory_limit:
+            super().__init__(data=file.file.read())
+        else:
+            path = temporary_path()
+            with open(path, "wb") as f:
+                shutil.copyfileobj(file.file, f, CHUNK_SIZE)
+            super().__init__(path=path)
+        self._owns_file = self.path is not None
+
+    def take_source(self) -> bytes | str:
+        """Returns the bytes or the path of the upload; a temporary file is then no longer removed by `close`."""
+        self._owns_file = False
+        return self.source
+
+    def close(self):
+        if self._owns_file:
+            remove_file(self.path)
+            self._owns_file = False
+
+
+def open_pdf(source: bytes | str) -> Document:
+    if isinstance(source, str):
+        return pymupdf.open(source, filetype="pdf")
+    return pymupdf.open(stream=source, filetype="pdf")
@@ -0,0 +1,278 @@
+"""
+Optional pool of pre-warmed worker processes for an NER engine.
+
+Each worker process loads the models of the configured engine once and then takes
+analysis requests, which wait in a bounded queue until a worker is free. The SSE events
+produced by the workers are routed back to the stream of the request that submitted the
+document, so that the inference of concurrent uploads runs in parallel instead of competing
+for the GIL.
+
+Every worker has its own pipes for tasks and results, so that a worker that is killed (e.g. for
+running out of memory) cannot leave a lock of a shared queue behind. A dead worker fails the
+request it was processing and is restarted. If a worker dies while loading its models, it is not
+restarted, since it would most likely fail again; once no worker is left, the pool fails all requests.
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Connection, wait
+from typing import Generator
+
+import engines
+import metrics
+from parallel import spawn_context
+from uploads import open_pdf
+
+# Number of worker processes; 0 disables the pool and runs the engine in the request thread.
+NER_WORKERS = int(os.getenv("NER_WORKERS", "0"))
+# Maximum number of requests waiting for a free worker before new requests are rejected.
+NER_QUEUE_SIZE = int(os.getenv("NER_QUEUE_SIZE", "16"))
+# Name of the engine of the workers (see `engines`); other engines run in the request thread.
+NER_ENGINE = os.getenv("NER_ENGINE", engines.DEFAULT_ENGINE)
+NER_PRELOAD_LANGUAGES = [
+    lang.strip() for lang in os.getenv("NER_PRELOAD_LANGUAGES", "de").split(",") if lang.strip()
+]
+# Seconds after which waiting requests check that the pool is still working.
+WORKER_CHECK_INTERVAL = float(os.getenv("WORKER_CHECK_INTERVAL", "1"))
+
+
+class _Failure:
+    """Marks an exception that was raised in a worker while processing a request."""
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+_done = None  # marks the end of the events of a request
+_ready = -1  # task id with which a worker reports that its models are loaded
+
+
+def _worker(engine: str, languages: list[str], workers: int, tasks: Connection, results: Connection):
+    from quantization import configure_threads
+
+    module = engines.get_engine(engine)
+    configure_threads(workers)  # share the cores with the other workers
+    module.preload(languages)
+    results.send((_ready, None))
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:  # the pool has gone away
+            break
+        if task is None:
+            break
+        task_id, pdf, prompt = task
+        try:
+            start = time.perf_counter()
+            doc = open_pdf(pdf)
+            # the timings are sent along with the final event and taken over by `metrics.track`
+            timings = metrics.new_timings(doc.page_count)
+            with metrics.recording(timings):
+                events = module.process_pdf_streaming(doc, prompt)
+            for event in metrics.with_timings(metrics.track(events(), engine, timings, start), timings):
+                results.send((task_id, event))
+        except Exception as e:
+            results.send((task_id, _Failure(f"{type(e).__name__}: {e}")))
+        results.send((task_id, _done))
+
+
+class _Worker:
+    """A worker process, its pipes, and the request it is processing."""
+
+    def __init__(self, ctx, args: tuple):
+        task_reader, self.tasks = ctx.Pipe(duplex=False)
+        self.results, result_writer = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=_worker, args=(*args, task_reader, result_writer), daemon=True)
+        self.process.start()
+        # only the worker uses these ends, so that reading from a dead worker's pipe raises EOFError
+        task_reader.close()
+        result_writer.close()
+        self.ready = False
+        self.task_id: int | None = None
+
+    def close(self):
+        self.tasks.close()
+        self.results.close()
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        engine: str = NER_ENGINE,
+        workers: int = NER_WORKERS,
+        queue_size: int = NER_QUEUE_SIZE,
+        languages: list[str] = NER_PRELOAD_LANGUAGES,
+    ):
+        # the processes are spawned, see `parallel.spawn_context`
+        self._ctx = spawn_context()
+        self._worker_args = (engine, languages, workers)
+        self._queue_size = queue_size
+        self._pending: deque[tuple[int, bytes | str, str]] = deque()
+        self._streams: dict[int, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._error: str | None = None  # set once no worker is left
+        self._closed = False
+        self._workers = [_Worker(self._ctx, self._worker_args) for _ in range(workers)]
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _assign(self):
+        """Sends waiting requests to idle workers (with the lock held)."""
+        for worker in self._workers:
+            if not self._pending:
+                return
+            if worker.ready and worker.task_id is None:
+                task = self._pending.popleft()
+                try:
+                    worker.tasks.send(task)
+                except OSError:  # the worker has died, the dispatcher will replace it
+                    self._pending.appendleft(task)
+                    continue
+                worker.task_id = task[0]
+
+    def _put(self, task_id: int, event):
+        with self._lock:
+            stream = self._streams.get(task_id)
+        if stream is not None:  # otherwise the client has disconnected
+            stream.put(event)
+
+    def _receive(self, worker: _Worker):
+        task_id, event = worker.results.recv()
+        if task_id == _ready:
+            with self._lock:
+                worker.ready = True
+                self._assign()
+            return
+        self._put(task_id, event)
+        if event is _done:
+            with self._lock:
+                worker.task_id = None
+                self._assign()
+
+    def _replace(self, worker: _Worker):
+        """Fails the request of a dead worker and restarts it."""
+        try:
+            while worker.results.poll():  # events sent before it died
+                self._receive(worker)
+        except (EOFError, OSError):
+            pass
+        worker.close()
+        worker.process.join(timeout=1)  # reaps the process, which sets its exit code
+        message = f"worker process {worker.process.pid} exited with code {worker.process.exitcode}"
+        if worker.task_id is not None:
+            self._put(worker.task_id, _Failure(message))
+        with self._lock:
+            if self._closed:
+                return
+            index = self._workers.index(worker)
+            if worker.ready:
+                print(f"Warning: NER {message}, restarting it")
+                self._workers[index] = _Worker(self._ctx, self._worker_args)
+                return
+            print(f"Warning: NER {message} while loading the models")
+            del self._workers[index]
+            if self._workers:
+                return
+            self._error = message
+            self._pending.clear()
+            streams = list(self._streams.values())
+        for stream in streams:
+            stream.put(_Failure(message))
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                workers = list(self._workers)
+            if not workers:
+                time.sleep(WORKER_CHECK_INTERVAL)
+                continue
+            by_connection = {worker.results: worker for worker in workers}
+            by_sentinel = {worker.process.sentinel: worker for worker in workers}
+            for ready in wait([*by_connection, *by_sentinel], timeout=WORKER_CHECK_INTERVAL):
+                if ready in by_sentinel:
+                    self._replace(by_sentinel[ready])
+                    continue
+                try:
+                    self._receive(by_connection[ready])
+                except (EOFError, OSError):
+                    pass  # the worker has died, its sentinel is handled in the next round
+
+    @property
+    def ready(self) -> bool:
+        """Whether all workers have loaded their models."""
+        with self._lock:
+            return bool(self._workers) and all(worker.ready for worker in self._workers)
+
+    def submit(self, pdf: bytes | str, prompt: str) -> Generator:
+        """
+        Queues a document (its bytes or its path) for analysis and returns a generator of its SSE events.
+        Raises `queue.Full` if all workers are busy and the queue is full, and RuntimeError if no worker is left.
+        """
+        task_id = next(self._ids)
+        stream = queue.Queue()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(f"Worker pool failed: {self._error}")
+            if len(self._pending) >= self._queue_size:
+                raise queue.Full
+            self._streams[task_id] = stream
+            self._pending.append((task_id, pdf, prompt))
+            self._assign()
+
+        def generate():
+            try:
+                while True:
+                    try:
+                        event = stream.get(timeout=WORKER_CHECK_INTERVAL)
+                    except queue.Empty:
+                        if not self._dispatcher.is_alive():
+                            raise RuntimeError("Analysis failed: the worker pool has been closed")
+                        continue
+                    if event is _done:
+                        break
+                    if isinstance(event, _Failure):
+                        raise RuntimeError(f"Analysis failed in worker: {event.message}")
+                    yield event
+            finally:
+                with self._lock:
+                    self._streams.pop(task_id, None)
+                    if task_id in (task[0] for task in self._pending):
+                        # the client has disconnected before a worker took the request
+                        self._pending = deque(task for task in self._pending if task[0] != task_id)
+
+        return generate
+
+    def close(self):
+        with self._lock:
+            self._closed = True  # so that the dispatcher stops and doesn't restart the workers
+            workers = self._workers
+            self._workers = []
+        self._dispatcher.join()
+        for worker in workers:
+            try:
+                worker.tasks.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join()
+            worker.close()
+
+
+_pool: WorkerPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkerPool:
+    """Returns the shared worker pool, starting it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+        return _pool
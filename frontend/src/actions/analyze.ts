@@ -1,5 +1,6 @@
 import * as React from "react";
 import type { SecuredactHighlight } from "../types/highlights";
+import { postWithPdf } from "./session";
 
 export const analyzePdf = async (
   currentPdfFile: File,
@@ -12,12 +13,12 @@ export const analyzePdf = async (
   setIsAnalyzing(true);
   try {
     const formData = new FormData();
-    formData.append("file", currentPdfFile);
     formData.append("prompt", customPrompt);
-    const response = await fetch("api/analyze-pdf", {
-      method: "POST",
-      body: formData,
-    });
+    const response = await postWithPdf(
+      "api/analyze-pdf",
+      currentPdfFile,
+      formData
+    );
     if (!response.ok) {
       throw new Error("Failed to analyze PDF");
     }
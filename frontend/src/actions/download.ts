@@ -1,4 +1,5 @@
 import type { IHighlight } from "react-pdf-highlighter";
+import { postWithPdf } from "./session";
 
 export const downloadPdf = async (
   currentPdfFile: File,
@@ -12,7 +13,6 @@ export const downloadPdf = async (
 
   try {
     const formData = new FormData();
-    formData.append("file", currentPdfFile);
 
     // Transform highlights back to PyMuPDF coordinate system
     const transformedHighlights = highlights.map((h) => {
@@ -33,10 +33,11 @@ export const downloadPdf = async (
     formData.append("annotations", JSON.stringify(transformedHighlights));
     formData.append("mode", isDraft ? "draft" : "final");
 
-    const response = await fetch("api/download-pdf", {
-      method: "POST",
-      body: formData,
-    });
+    const response = await postWithPdf(
+      "api/download-pdf",
+      currentPdfFile,
+      formData
+    );
 
     if (!response.ok) {
       throw new Error("Failed to save annotations");
@@ -0,0 +1,30 @@
+// The backend keeps uploaded PDFs in a session, so that analysis and download
+// can refer to the session ID instead of uploading the file again.
+const sessionIds = new WeakMap<File, string>();
+
+export const setSessionId = (file: File, sessionId: string) => {
+  sessionIds.set(file, sessionId);
+};
+
+// Sends the form data with the session ID of the file if there is one, and falls back
+// to sending the file itself if there is no session or it has expired on the server.
+export const postWithPdf = async (
+  url: string,
+  file: File,
+  formData: FormData
+): Promise<Response> => {
+  const sessionId = sessionIds.get(file);
+  if (sessionId) {
+    const sessionFormData = new FormData();
+    for (const [key, value] of formData) sessionFormData.append(key, value);
+    sessionFormData.append("session_id", sessionId);
+    const response = await fetch(url, {
+      method: "POST",
+      body: sessionFormData,
+    });
+    if (response.status !== 404) return response;
+    sessionIds.delete(file);
+  }
+  formData.append("file", file);
+  return fetch(url, { method: "POST", body: formData });
+};
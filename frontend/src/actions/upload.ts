@@ -1,4 +1,5 @@
 import { SecuredactHighlight } from "../types/highlights";
+import { setSessionId } from "./session";
 
 export const uploadPdf = async (
   event: React.ChangeEvent<HTMLInputElement>,
@@ -23,16 +24,19 @@ export const uploadPdf = async (
         throw new Error("Failed to save annotations");
       }
 
-      const responseData = await response.json();
-      const { pdf: pdfBase64, highlights } = responseData;
-
-      // Convert base64 PDF back to blob
-      const pdfBlob = await fetch(
-        `data:application/pdf;base64,${pdfBase64}`
-      ).then((res) => res.blob());
+      // The response contains the highlights (JSON) and the PDF without redaction annotations (binary)
+      const responseData = await response.formData();
+      const highlights: Array<SecuredactHighlight> = JSON.parse(
+        responseData.get("highlights") as string
+      );
+      const pdfBlob = responseData.get("pdf") as Blob;
       const fileWithoutRedactionAnnotations = new File([pdfBlob], file.name, {
         type: "application/pdf",
       });
+      setSessionId(
+        fileWithoutRedactionAnnotations,
+        responseData.get("session") as string
+      );
 
       // Create URL from the processed file
       const processedFileUrl = URL.createObjectURL(